@@ -20,26 +20,31 @@ class GeometryConverter():
         self.srs = osr.SpatialReference()
         self.srs.ImportFromEPSG(5650)
 
-    def __makeShapefile(self, geometries, filename, filter="POLYGON"):
+    def prefetch(self, bbox):
         '''
-            Save the Geometries into a new ESRI Shapefile with the specified
-            name
+            Fetches all WFS geometries within the (big) bbox at once, see
+            WFSHandling.Feldblock_WFS.prefetch
+        '''
+        self.fb_wfs.prefetch(bbox)
+
+    def __makeLayer(self, geometries, filter="POLYGON"):
+        '''
+            Puts the Geometries into a new layer of an OGR Memory data source
 
             Parameters
             ----------
             geometries: Geometry[]
-                - the list of geometries to be saved
-            filename: String
-                - name for the shapefile (without '.shp')
+                - the list of geometries to be added
             filter: string
                 - "LINESTRING" or "POLYGON"
 
             Returns
             -------
-            number of geometries saved
+            the data source (keep it referenced while using the layer), the
+            layer and the number of geometries added
         '''
-        shp_driver = ogr.GetDriverByName('ESRI Shapefile')
-        source = shp_driver.CreateDataSource(filename + '.shp')
+        mem_driver = ogr.GetDriverByName('Memory')
+        source = mem_driver.CreateDataSource('geometries')
         # create the layer
         if filter == "POLYGON":
             layer = source.CreateLayer("geometries", self.srs, ogr.wkbPolygon)
@@ -49,7 +54,7 @@ class GeometryConverter():
 
         def addFeature(geometry, layer):
             '''
-                Adds the geometry to the shapefile layer
+                Adds the geometry to the layer
             '''
             if geometry.IsEmpty():
                 return
@@ -57,7 +62,6 @@ class GeometryConverter():
             feature.SetGeometry(geometry)
             layer.CreateFeature(feature)
 
-        # Process the text file, add the features to the shapefile
         i = 0
         for g in geometries:
             if g.GetGeometryName() == filter:
@@ -67,40 +71,31 @@ class GeometryConverter():
                 for geom in g:
                     addFeature(geom, layer)
                     i += 1
-        # Save and close the data source
-        source = None
-        return i
+        return source, layer, i
 
-    def __convertShapefile2RasterArray(self, filename, keepFile=False):
+    def __convertLayer2RasterArray(self, source_layer, bbox):
         '''
-            Converts the layer of a shapefile to a raster data array
+            Converts the layer to a raster data array, in a GDAL MEM dataset
 
             Parameters:
             ----------
-            filename: string
-                - name of the shapefile without this.NAME_EXTENT + '.shp'
-            keepFile: Boolean (optional)
-                - whether or not to produce a file representing the shapefile
-                  with the name 'filename.shp'
-                - default: False
+            source_layer: Layer
+                - the layer holding the geometries
+            bbox: float[xmin, ymin, xmax, ymax]
+                - the bbox the array is covering
 
             Returns:
             -------
             the array containing the image data
         '''
-        # Open the source layer and read out the extent
-        source = ogr.Open(filename + '.shp')
-        source_layer = source.GetLayer()
+        # read out the extent
         x_min, x_max, y_min, y_max = source_layer.GetExtent()
         x_size = int(np.max([round((x_max - x_min) / PIXELSIZE), 1]))
         y_size = int(np.max([round((y_max - y_min) / PIXELSIZE), 1]))
 
-        edgeFile = filename + EDGES_EXTENT + '.tif'
-
         # Create the destination data source
-        rast_driver = gdal.GetDriverByName('GTiff')
-        data = rast_driver.Create(edgeFile, x_size, y_size, 1,
-                                  gdal.GDT_Byte, ['NBITS=1'])
+        rast_driver = gdal.GetDriverByName('MEM')
+        data = rast_driver.Create('', x_size, y_size, 1, gdal.GDT_Byte)
         data.SetGeoTransform((x_min, PIXELSIZE, 0, y_max, 0, -PIXELSIZE))
 
         band = data.GetRasterBand(1)
@@ -108,34 +103,29 @@ class GeometryConverter():
         # rasterize and get array
         gdal.RasterizeLayer(data, [1], source_layer, burn_values=[1])
         array = band.ReadAsArray()
-        data.GetRasterBand(1).WriteArray(array)
 
         # at this point geometries may not fill the whole bbox, so we need to
         # fix that
         # transform array to the wanted size
-        bbox = getBBoxForTifFile(filename + '.tif')
         x = int(round((x_min - bbox[0]) / PIXELSIZE))
         y = int(round((bbox[3] - y_max) / PIXELSIZE))
         raster = np.zeros((IMAGE_SIZE_SMALL, IMAGE_SIZE_SMALL))
         raster[y:y + y_size, x:x + x_size] = array
 
         data = None
-        deleteShapefile(filename)
-        if not keepFile:
-            os.remove(edgeFile)
         return raster
 
-    def __geometries2RasterArray(self, geometries, file, keepFile=False,
-                                 filter="POLYGON"):
+    def __geometries2RasterArray(self, geometries, bbox, filter="POLYGON"):
         '''
-            Convert geometry list to raster data array (and save it)
+            Convert geometry list to raster data array, without writing any
+            file
 
             Parameters
             ----------
             geometries: Geometry[]
                 - the list of LineStrings to be saved
-            file: String
-                - name for the edge file without '.tif'
+            bbox: float[xmin, ymin, xmax, ymax]
+                - the bbox the array is covering
             filter: string
                 - "LINESTRING" oder "POLYGON"
 
@@ -143,13 +133,111 @@ class GeometryConverter():
             -------
             the array containing the image data
         '''
-        if self.__makeShapefile(geometries, file, filter) == 0:
-            return getEmptyRasterArray(file)
-        raster = self.__convertShapefile2RasterArray(file, keepFile=keepFile)
+        source, layer, count = self.__makeLayer(geometries, filter)
+        if count == 0:
+            return getEmptyRasterArray(None, bbox=bbox)
+        raster = self.__convertLayer2RasterArray(layer, bbox)
+        source = None
         if len(raster.shape) == 3:
             return raster[:, :, 0]
         return raster
 
+    def __geometries2RasterBands(self, groups, bbox):
+        '''
+            Burns the geometry groups into the bands of one GDAL MEM dataset
+            on the grid of the bbox. The bands write straight into
+            preallocated uint8 arrays: the first three groups into a 3
+            channel array, the fourth into a single channel array
+
+            Parameters
+            ----------
+            groups: (Geometry[], filter)[]
+                - 4 groups, filter is "LINESTRING" or "POLYGON"
+            bbox: float[xmin, ymin, xmax, ymax]
+                - the bbox the arrays are covering
+
+            Returns
+            -------
+            the single channel array and the 3 channel array, 255 where a
+            geometry is
+        '''
+        assert len(groups) == 4, 'need exactly 4 geometry groups'
+        x_size = int(round((bbox[2] - bbox[0]) / PIXELSIZE))
+        y_size = int(round((bbox[3] - bbox[1]) / PIXELSIZE))
+        raster_groups = np.zeros((y_size, x_size, 3), dtype=np.uint8)
+        raster_single = np.zeros((y_size, x_size), dtype=np.uint8)
+
+        rast_driver = gdal.GetDriverByName('MEM')
+        data = rast_driver.Create('', x_size, y_size, 0, gdal.GDT_Byte)
+        data.SetGeoTransform((bbox[0], PIXELSIZE, 0, bbox[3], 0, -PIXELSIZE))
+        for k in range(3):
+            data.AddBand(gdal.GDT_Byte,
+                         ['DATAPOINTER=' + str(raster_groups.ctypes.data + k),
+                          'PIXELOFFSET=3', 'LINEOFFSET=' + str(3 * x_size)])
+        data.AddBand(gdal.GDT_Byte,
+                     ['DATAPOINTER=' + str(raster_single.ctypes.data),
+                      'PIXELOFFSET=1', 'LINEOFFSET=' + str(x_size)])
+
+        for band, (geometries, filter) in enumerate(groups, 1):
+            source, layer, count = self.__makeLayer(geometries, filter)
+            if count > 0:
+                gdal.RasterizeLayer(data, [band], layer, burn_values=[255])
+            source = None
+
+        data = None
+        return raster_single, raster_groups
+
+    def share(self, other):
+        '''
+            Uses the prefetched geometries of the other converter, so every
+            thread of a pipeline can have its own converter without fetching
+            them again, see WFSHandling.Feldblock_WFS.share
+        '''
+        self.fb_wfs.share(other.fb_wfs)
+
+    def findGeometries(self, bbox):
+        '''
+            The geometries for the edge map of the bbox, see
+            WFSHandling.Feldblock_WFS.findGeometries
+        '''
+        return self.fb_wfs.findGeometries(bbox)
+
+    def findGeometriesByGroup(self, bbox, manipulate=False, seed=None):
+        '''
+            The geometries for the rasters of the 2nd net, see
+            WFSHandling.Feldblock_WFS.findGeometriesByGroup
+        '''
+        return self.fb_wfs.findGeometriesByGroup(bbox, manipulate, seed)
+
+    def geometries2EdgeMap(self, geometries, bbox):
+        '''
+            Rasterizes the geometries found by findGeometries
+
+            Returns
+            -------
+            the raster array containing the Edge within the BBox
+            None - if no Polygon from the WFS is intersecting the BBox
+        '''
+        if not geometries:
+            return None
+        return self.__geometries2RasterArray(geometries, bbox,
+                                             filter="LINESTRING")
+
+    def geometries2Rasters(self, groups, bbox):
+        '''
+            Rasterizes the geometries found by findGeometriesByGroup
+
+            Returns
+            -------
+            2 uint8 arrays (0 or 255) representing the rasters:
+                1st: EdgeMap raster
+                2nd: 3 channel (FB, LE, NBF) classification raster
+        '''
+        fb, le, nbf, boundaries = groups
+        return self.__geometries2RasterBands(
+            [(fb, "POLYGON"), (le, "POLYGON"), (nbf, "POLYGON"),
+             (boundaries, "LINESTRING")], bbox)
+
     def bbox2EdgeMap(self, bbox, file, keepEdgeMapFile=False):
         '''
             Get the raster of the EdgeMap for the provided bounding Box
@@ -166,14 +254,10 @@ class GeometryConverter():
             the raster array containing the Edge within the BBox
             None - if no Polygon from the WFS is intersecting the BBox
         '''
-        geometriesInBBox = self.fb_wfs.findGeometries(bbox)
-        if len(geometriesInBBox):
-            return None
+        geometriesInBBox = self.findGeometries(bbox)
         # print('WFS found', len(geometriesInBBox), 'geometries for', bbox)
-        raster = self.__geometries2RasterArray(geometriesInBBox, file,
-                                               keepFile=keepEdgeMapFile,
-                                               filter="LINESTRING")
-        if keepEdgeMapFile:
+        raster = self.geometries2EdgeMap(geometriesInBBox, bbox)
+        if raster is not None and keepEdgeMapFile:
             cv2.imwrite(file + EDGES_EXTENT + '.tif', raster)
         # print('dots made: ', sum(sum(raster)), '/',
         # len(raster)*len(raster[0]), ' -> ',
@@ -198,30 +282,17 @@ class GeometryConverter():
 
             Returns
             -------
-            2 lists representing the rasters:
+            2 uint8 arrays (0 or 255) representing the rasters:
                 1st: EdgeMap raster
                 2nd: 3 channel (FB, LE, NBF) classification raster
         '''
         if '22' in file:
             print('still fein')
-        fb, le, nbf, boundaries = self.fb_wfs.findGeometriesByGroup(bbox,
-                                                                    manipulate)
+        groups = self.findGeometriesByGroup(bbox, manipulate)
 
         if '22' in file:
-            print('auch gut', len(fb), len(le), len(nbf))
-        raster_fb = self.__geometries2RasterArray(fb, file) * 255
-        raster_le = self.__geometries2RasterArray(le, file) * 255
-        raster_nbf = self.__geometries2RasterArray(nbf, file) * 255
-
-        shape = (raster_fb.shape[0], raster_fb.shape[1], 1)
-        raster_groups = np.concatenate((raster_fb.reshape(shape),
-                                        raster_le.reshape(shape),
-                                        raster_nbf.reshape(shape)), 2)
-
-        raster_bound = self.__geometries2RasterArray(boundaries, file,
-                                                     filter="LINESTRING") * 255
-
-        return raster_bound, raster_groups
+            print('auch gut', len(groups[0]), len(groups[1]), len(groups[2]))
+        return self.geometries2Rasters(groups, bbox)
 
 
 def deleteShapefile(file):
@@ -240,7 +311,7 @@ def deleteShapefile(file):
         os.remove(file + '.shx')
 
 
-def getEmptyRasterArray(file, keepFile=False):
+def getEmptyRasterArray(file, keepFile=False, bbox=None):
     '''
         produces an empty raster array, same sized as the given file
 
@@ -248,21 +319,24 @@ def getEmptyRasterArray(file, keepFile=False):
         ----------
         file: String
             - name for the edge file without the EXTENT and without '.tif'
+        bbox: float[xmin, ymin, xmax, ymax] (optional)
+            - the bbox of the raster, read for the file if not given
 
         Returns
         -------
         the 0-filled array
     '''
     # calculate array size
-    x_min, y_min, x_max, y_max = getBBoxForTifFile(file + '.tif')
-    x_size = int((x_max - x_min) / PIXELSIZE)
-    y_size = int((y_max - y_min) / PIXELSIZE)
+    if bbox is None:
+        bbox = getBBoxForTifFile(file + '.tif')
+    x_min, y_min, x_max, y_max = bbox
+    x_size = int(round((x_max - x_min) / PIXELSIZE))
+    y_size = int(round((y_max - y_min) / PIXELSIZE))
 
     empty_raster = np.zeros((x_size, y_size))
     if keepFile:
         edgeFile = file + EDGES_EXTENT + '.tif'
         cv2.imwrite(edgeFile, empty_raster)
-    deleteShapefile(file)
     return empty_raster
 
 
@@ -274,14 +348,28 @@ def getNoClassRaster(raster):
         Parameters
         ----------
         raster: the 3 channel classification raster
+
+        Returns
+        -------
+        uint8 array of shape (height, width, 1)
+    '''
+    return getNoClassRasters(raster[np.newaxis])[0]
+
+
+def getNoClassRasters(rasters):
+    '''
+        getNoClassRaster for a stack of classification rasters
+
+        Parameters
+        ----------
+        rasters: array of shape (N, height, width, 3)
+
+        Returns
+        -------
+        uint8 array of shape (N, height, width, 1)
     '''
-    shape = (raster.shape[0], raster.shape[1], 1)
-    raster_nothing = np.zeros(shape)
-    for i in range(shape[0] - 1):
-        for j in range(shape[1] - 1):
-            if sum(raster[i, j]) == 0:
-                raster_nothing[i, j] = 255
-    return raster_nothing
+    nothing = ~np.any(rasters, axis=3, keepdims=True)
+    return nothing.astype(np.uint8) * np.uint8(255)
 
 
 def getBBoxForTifFile(file):
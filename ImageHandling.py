@@ -8,15 +8,68 @@ import sys
 import os.path
 import timeit
 import codecs
+import hashlib
+import json
+import time
 import numpy as np
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from osgeo import gdal
+import h5py
 import GeometryConvertion as gc
 import WMSHandling as wms
 import Params
 from Params import (GROUPS_EXTENT, EDGES_EXTENT, BBOX_EXTENT, IMAGE_SIZE_SMALL,
-                    PIXELSIZE, DOP_PATH, SMALL_DOP_TRAIN, DOM_EXTENT)
+                    PIXELSIZE, DOP_PATH, SMALL_DOP_TRAIN, DOM_EXTENT, WORKERS,
+                    WFS_BULK_QUERY, NO_DATA_AREA_EXTENT, STORAGE, SHARD_SIZE,
+                    PIPELINE_QUEUE_SIZE, PIPELINE_GEOMETRY_WORKERS,
+                    PIPELINE_RASTER_WORKERS, PIPELINE_DOM_WORKERS,
+                    PIPELINE_WRITE_WORKERS, MANIFEST, MANIFEST_VERIFY)
 # import random
 
 
+class WindowedImage():
+    '''
+        class that reads windows of a big image file with GDAL, so only the
+        pixels of the requested window are held in memory
+    '''
+
+    def __init__(self, ImagePath):
+        self.file = ImagePath
+        self.dataset = gdal.Open(ImagePath)
+        if self.dataset is None:
+            print("Unable to open " + ImagePath)
+            sys.exit()
+        # same channel order as cv2.imread: BGR
+        if self.dataset.RasterCount >= 3:
+            self.bands = [3, 2, 1]
+        else:
+            self.bands = [1, 1, 1]
+        self.shape = (self.dataset.RasterYSize, self.dataset.RasterXSize,
+                      len(self.bands))
+
+    def read(self, xoff, yoff, xsize, ysize):
+        '''
+            Reads the window of the image
+
+            Parameters
+            ----------
+            xoff, yoff: int
+                - pixel column and row of the upper left corner
+            xsize, ysize: int
+                - number of columns and rows of the window
+
+            Returns
+            -------
+            the image matrix of the window (ysize, xsize, 3) like cv2.imread
+        '''
+        bands = [self.dataset.GetRasterBand(b).ReadAsArray(xoff, yoff, xsize,
+                                                           ysize)
+                 for b in self.bands]
+        return np.dstack(bands)
+
+
 class ImageProcessor():
     '''
         class that processes one big Image to smaller pieces
@@ -26,89 +79,210 @@ class ImageProcessor():
         self.bigFile = ImagePath
         self.bigBBox = gc.getBBoxForTifFile(ImagePath)
         self.xmin, self.ymin, self.xmax, self.ymax = self.bigBBox
-        self.bigImage = openImageFile(ImagePath)
+        # just the windows needed are read in process
+        self.bigImage = WindowedImage(ImagePath)
 
         imageName = re.compile(r'(dop20.*).tif')
         self.imageName = imageName.search(self.bigFile).group(1)
 
         self.converter = gc.GeometryConverter()
 
-    def __saveSmallerBBox(self, file, bbox):
+    def __converter(self):
         '''
-            Saves the BBox for the previously produced smaller image
-
-            Parameters
-            ----------
-            file: string
-                - the path of the smaller image with its name
-                - like 'path/to/this/filename' without '.tif'
-
-            bbox: float[xmin, ymin, xmax, ymax]
-                - in meters to the (Coordinate System)
+            The GeometryConverter of the current thread, sharing the
+            prefetched geometries of self.converter
         '''
-        assert len(bbox) == 4, 'wrong BBox argument size'
-        filename = file + BBOX_EXTENT
-        text_file = open(filename, "w")
-        for value in bbox:
-            text_file.write(str(value) + '\n')
-        text_file.close()
+        converter = getattr(self.local, 'converter', None)
+        if converter is None:
+            converter = gc.GeometryConverter()
+            converter.share(self.converter)
+            self.local.converter = converter
+        return converter
 
-    def __save(self, smallImage, name, bbox, forTraining=True,
-               for2ndNet=False):
+    def __crop(self, columns, ranY, size_wanted, newFilename):
         '''
-            Gets the edge map and dom map and saves them, along the bbox and
-            the image itself
-
-            # degrees: (0=0, 1=90, 2=180, 3=270)
-            # flip: (f=flipped up'n'down , n=no flip)
+            1st stage: reads the windows of the big image
 
-            Parameters
-            ----------
-            smallImage: the image-like matrix
+            Returns
+            -------
+            generator of tiles: dict with 'name', 'bbox', 'image', 'stages'
+            - without the tiles finished by an earlier build
+        '''
+        x, y = size_wanted
+        height = x * PIXELSIZE
+        length = y * PIXELSIZE
+        for i in columns:
+            for j in range(0, ranY):
+                name = newFilename + '_' + str(i * ranY + j + 1)
+                if name in self.resumed:
+                    continue
+                yield {'name': name,
+                       'bbox': [self.xmin + i * length,
+                                self.ymax - (j + 1) * height,
+                                self.xmin + (i + 1) * length,
+                                self.ymax - j * height],
+                       'image': self.bigImage.read(i * x, j * y, x, y),
+                       'stages': ['crop']}
 
-            name: where the shortcuts will be added to
+    def __findTileGeometries(self, tile):
+        '''
+            2nd stage: finds the geometries within the bbox of the tile
+        '''
+        converter = self.__converter()
+        if self.for2ndNet:
+            # the false data just for the tiles kept, see __rasterizeTile
+            tile['geometries'] = converter.findGeometriesByGroup(tile['bbox'])
+        else:
+            tile['geometries'] = converter.findGeometries(tile['bbox'])
+        return tile
 
-            bbox: float[xmin, ymin, xmax, ymax]
+    def __rasterizeTile(self, tile):
+        '''
+            3rd stage: rasterizes the geometries of the tile to the edge map
+            and for the 2nd net to the groups, nothing and false data rasters
 
-            forTraining: boolean
-                - if true: if there is no geometry within the bbox, the images
-                won't be saved
+            Returns
+            -------
+            the tile, None if it is skipped:
+                - for training, if there is no geometry within the bbox
+                - for the 2nd net, if there is no group geometry
         '''
-        self.__saveSmallerBBox(name, bbox)
-        if for2ndNet:
+        converter = self.__converter()
+        bbox = tile['bbox']
+        if self.for2ndNet:
             # true data
-            edge_map, groups = self.converter.bbox2geometryRasters(bbox, name)
+            edge_map, groups = converter.geometries2Rasters(
+                tile.pop('geometries'), bbox)
             # no Geometry Data found
             if np.max(groups) == 0:
-                os.remove(name + BBOX_EXTENT)
-                return
-            cv2.imwrite(name + GROUPS_EXTENT + '.tif', groups)
-            if '22' in name:
-                print('schicki heinz')
-            # make false data
-            f_em, f_g = self.converter.bbox2geometryRasters(bbox, name, True)
-            if '22' in name:
-                print(f_em)
-            cv2.imwrite(name + GROUPS_EXTENT + '_f.tif', f_g)
-            cv2.imwrite(name + EDGES_EXTENT + '_f.tif', f_em)
-
+                return None
+            tile['groups'] = groups
+            tile['nothing'] = gc.getNoClassRaster(groups)
+            # make false data, seeded by the tile so that it is the same in
+            # every run whatever thread handles the tile
+            geometries_f = converter.findGeometriesByGroup(
+                bbox, True, os.path.basename(tile['name']))
+            tile['edges_f'], tile['groups_f'] = converter.geometries2Rasters(
+                geometries_f, bbox)
         else:
-            edge_map = gc.bbox2EdgeMap(bbox, name)
+            edge_map = converter.geometries2EdgeMap(tile.pop('geometries'),
+                                                    bbox)
         if edge_map is None:
-            if forTraining:
-                os.remove(name + BBOX_EXTENT)
-                return
-            else:
-                edge_map = gc.getEmptyRasterArray(name)
+            if self.forTraining:
+                return None
+            edge_map = gc.getEmptyRasterArray(tile['name'], bbox=bbox)
+
+        tile['edges'] = edge_map
+        return tile
 
-        cv2.imwrite(name + '.tif', smallImage)
-        wms.getDOMMap4ImageAndSaveAsPNG(name + '.tif', bbox)
-        cv2.imwrite(name + EDGES_EXTENT + '.tif', edge_map)
+    def __fetchTileDOM(self, tile):
+        '''
+            4th stage: gets the DOM of the tile from the WMS
+        '''
+        tile['dom'] = wms.getDOMMap(tile['bbox'])
+        return tile
+
+    def __writeTile(self, tile):
+        '''
+            5th stage: saves the tile with self.writer
+        '''
+        if self.manifest is None and tile['dom'] is None:
+            # without manifest no later build adds the DOM
+            self.__record(tile, 'failed')
+            return None
+        files = self.writer.write(tile)
+        if self.manifest is not None:
+            tile['stages'].append('write')
+            if tile['dom'] is None:
+                self.__record(tile, 'failed', files)
+                return None
+            self.manifest.record(tile, 'saved', files)
+        return tile
+
+    def __writeTileDOM(self, tile):
+        '''
+            Saves just the DOM of a tile, whose other files were written
+            by an earlier build
+        '''
+        if tile['dom'] is None:
+            self.__record(tile, 'failed', tile['files'])
+            return None
+        tile['files'].update(self.writer.writeDOM(tile))
+        self.manifest.record(tile, 'saved', tile['files'])
+        return tile
+
+    def __record(self, tile, status, files=None):
+        '''
+            Records the state of the tile in the manifest, if there is one,
+            and counts the failed tiles
+        '''
+        if status == 'failed':
+            with self.lock:
+                self.failed += 1
+        if self.manifest is not None:
+            self.manifest.record(tile, status, files)
+
+    def __recorded(self, stage, function):
+        '''
+            Wraps the stage function, so its result is recorded in the
+            manifest: failed tiles are dropped and built again by the next
+            run, except for a failed DOM request, then the other files are
+            still written and the next run just gets the DOM (without
+            manifest the tile is dropped as failed by __writeTile)
 
-    def process(self, dirTo, forTraining, size_wanted, for2ndNet):
+            Returns
+            -------
+            the wrapped function
+        '''
+        def run(tile):
+            try:
+                result = function(tile)
+            except Exception as e:
+                print('tile ' + os.path.basename(tile['name']) + ': ' +
+                      stage + ' failed, ' + str(e))
+                if stage == 'dom':
+                    tile['dom'] = None
+                    return tile
+                self.__record(tile, 'failed')
+                return None
+            if result is None:
+                # the write stages record their tiles themselves
+                if stage != 'write':
+                    self.__record(tile, 'skipped')
+                return None
+            if stage not in tile['stages']:
+                tile['stages'].append(stage)
+            return result
+        return run
+
+    def process(self, dirTo, forTraining, size_wanted, for2ndNet,
+                columns=None, storage=STORAGE):
         '''
             starts producing smaller images and finding all other needed raster
             arrays
+
+            Parameters
+            ----------
+            storage: string
+                - 'files': every tile as single files next to each other, an
+                interrupted build resumes with the manifest, see BuildManifest
+                - 'hdf5': all tiles in HDF5 shards, see ShardWriter, not
+                resumable: the shards of an earlier build of the columns are
+                removed and all tiles are built anew
+
+            columns: range (optional)
+                - the tile columns (i) to produce, all columns if not given
+                - the names stay '<name>_<i*ranY+j+1>', so splitting the
+                columns over several processes gives the same files
+
+            Returns
+            -------
+            report: dict
+                - 'image': name of the big image
+                - 'saved', 'skipped', 'failed': number of small images, a
+                tile failing in a stage is counted and dropped, the others
+                go on
+                - 'resumed': number of them finished by earlier builds
         '''
         assert len(size_wanted) == 2, 'need 2 dimensional size'
         x = size_wanted[0]
@@ -116,6 +290,8 @@ class ImageProcessor():
 
         ranX = int(self.bigImage.shape[0] / x)
         ranY = int(self.bigImage.shape[1] / y)
+        if columns is None:
+            columns = range(0, ranX)
 
         height = x * PIXELSIZE
         length = y * PIXELSIZE
@@ -123,18 +299,484 @@ class ImageProcessor():
         # name of the specific image
         print(self.imageName)
         newFilename = dirTo + self.imageName
+        report = {'image': self.imageName, 'saved': 0, 'skipped': 0,
+                  'failed': 0, 'resumed': 0}
+        if len(columns) == 0:
+            return report
 
-        for i in range(0, ranX):
-            newBBox = [self.xmin + i * length, 0,
-                       self.xmin + (i + 1) * length, 0]
-            for j in range(0, ranY):
-                image_ij = self.bigImage[(j * y): ((j + 1) * y),
-                                         (i * x): ((i + 1) * x)]
-                newName = newFilename + '_' + str(i * ranY + j + 1)
-                newBBox[1] = self.ymax - (j + 1) * height
-                newBBox[3] = self.ymax - j * height
-                self.__save(smallImage=image_ij, name=newName, bbox=newBBox,
-                            forTraining=forTraining, for2ndNet=for2ndNet)
+        if WFS_BULK_QUERY:
+            # one WFS request per layer for all tiles of these columns
+            self.converter.prefetch([self.xmin + columns[0] * length,
+                                     self.ymax - ranY * height,
+                                     self.xmin + (columns[-1] + 1) * length,
+                                     self.ymax])
+
+        if storage == 'hdf5':
+            prefix = newFilename + '_' + str(columns[0])
+            # shards can't resume, they would mix with the ones built now
+            for shard in glob.glob(prefix + '_*.h5'):
+                os.remove(shard)
+            self.writer = ShardWriter(prefix)
+            writeWorkers = 1
+        else:
+            self.writer = TileFileWriter()
+            writeWorkers = PIPELINE_WRITE_WORKERS
+
+        # shards are written anew by every run, just single files can resume
+        self.manifest = None
+        self.resumed = set()
+        self.failed = 0
+        self.lock = threading.Lock()
+        if MANIFEST and storage == 'files':
+            self.manifest = BuildManifest(dirTo, self.imageName, columns[0])
+            names = [newFilename + '_' + str(i * ranY + j + 1)
+                     for i in columns for j in range(0, ranY)]
+            report['resumed'], domTiles = self.__resume(names, report)
+        stages = [('geometries', self.__findTileGeometries,
+                   PIPELINE_GEOMETRY_WORKERS),
+                  ('rasterize', self.__rasterizeTile, PIPELINE_RASTER_WORKERS),
+                  ('dom', self.__fetchTileDOM, PIPELINE_DOM_WORKERS)]
+
+        # the WFS/WMS requests of some tiles overlap with the rasterizing and
+        # writing of others
+        self.forTraining = forTraining
+        self.for2ndNet = for2ndNet
+        self.local = threading.local()
+        try:
+            if self.manifest is not None and domTiles:
+                # tiles whose DOM request failed in an earlier build
+                pipeline = Pipeline()
+                pipeline.addStage(self.__recorded('dom', self.__fetchTileDOM),
+                                  PIPELINE_DOM_WORKERS)
+                pipeline.addStage(self.__recorded('write',
+                                                  self.__writeTileDOM))
+                saved, failed = pipeline.run(domTiles)
+                report['saved'] += saved
+                report['skipped'] += failed
+
+            pipeline = Pipeline()
+            for stage, function, workers in stages:
+                pipeline.addStage(self.__recorded(stage, function), workers)
+            pipeline.addStage(self.__recorded('write', self.__writeTile),
+                              writeWorkers)
+            saved, skipped = pipeline.run(
+                self.__crop(columns, ranY, size_wanted, newFilename))
+            report['saved'] += saved
+            report['skipped'] += skipped
+        finally:
+            self.writer.close()
+            # failed tiles are dropped by the pipelines as well
+            report['failed'] = self.failed
+            report['skipped'] -= self.failed
+            if self.manifest is not None:
+                self.manifest.close()
+        return report
+
+    def __resume(self, names, report):
+        '''
+            Looks up the tiles in the manifest: finished tiles are counted in
+            the report and left out by __crop (self.resumed)
+
+            Returns
+            -------
+            the number of finished tiles and the tiles that just miss their
+            DOM
+        '''
+        domTiles = []
+        for name in names:
+            state, entry = self.manifest.state(name)
+            if state == 'saved' or state == 'skipped':
+                report[state] += 1
+                self.resumed.add(name)
+            elif state == 'dom':
+                domTiles.append({'name': name, 'bbox': entry['bbox'],
+                                 'stages': entry['stages'],
+                                 'files': entry['files']})
+                self.resumed.add(name)
+        return len(self.resumed) - len(domTiles), domTiles
+
+
+class Pipeline():
+    '''
+        class that runs items through stages connected by bounded queues,
+        every stage with its own worker threads, so the network bound and
+        the CPU bound stages work at the same time
+    '''
+
+    def __init__(self, queueSize=PIPELINE_QUEUE_SIZE):
+        self.queueSize = queueSize
+        self.stages = []
+
+    def addStage(self, function, workers=1):
+        '''
+            Parameters
+            ----------
+            function: item -> item
+                - returns the item for the next stage or None to drop it
+            workers: int
+                - number of threads running the function
+        '''
+        self.stages.append((function, max(workers, 1)))
+
+    def __work(self, stage, queues, remaining, counts):
+        '''
+            Runs the function of the stage on the items of its queue until
+            the end marker (None), the last worker of the stage passes one
+            end marker per worker on to the next stage
+        '''
+        function, workers = self.stages[stage]
+        last = stage == len(self.stages) - 1
+        while True:
+            item = queues[stage].get()
+            if item is None:
+                break
+            # after an error the items are just drained
+            if self.error is not None:
+                continue
+            try:
+                item = function(item)
+            except Exception as e:
+                with self.lock:
+                    if self.error is None:
+                        self.error = e
+                continue
+            if item is None:
+                with self.lock:
+                    counts['dropped'] += 1
+            elif last:
+                with self.lock:
+                    counts['passed'] += 1
+            else:
+                queues[stage + 1].put(item)
+
+        with self.lock:
+            remaining[stage] -= 1
+            done = remaining[stage] == 0
+        if done and not last:
+            for _ in range(self.stages[stage + 1][1]):
+                queues[stage + 1].put(None)
+
+    def run(self, items):
+        '''
+            Puts the items through all stages, raises the first error of a
+            stage after all threads ended
+
+            Parameters
+            ----------
+            items: iterable
+                - read in the calling thread
+
+            Returns
+            -------
+            the number of items that passed all stages and the number of
+            dropped items
+        '''
+        self.error = None
+        self.lock = threading.Lock()
+        queues = [queue.Queue(maxsize=self.queueSize) for _ in self.stages]
+        remaining = [workers for _, workers in self.stages]
+        counts = {'passed': 0, 'dropped': 0}
+        threads = []
+        for stage, (_, workers) in enumerate(self.stages):
+            for _ in range(workers):
+                thread = threading.Thread(target=self.__work,
+                                          args=(stage, queues, remaining,
+                                                counts))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+        try:
+            for item in items:
+                if self.error is not None:
+                    break
+                queues[0].put(item)
+        finally:
+            for _ in range(self.stages[0][1]):
+                queues[0].put(None)
+            for thread in threads:
+                thread.join()
+
+        if self.error is not None:
+            raise self.error
+        return counts['passed'], counts['dropped']
+
+
+class BuildManifest():
+    '''
+        class that records the state of every tile of a build as JSON lines
+        in '<dirTo><image name>_manifest_<first column>.jsonl', so an
+        interrupted build skips the finished tiles and repeats just the
+        failed stages of the others
+
+        one line per tile and state:
+            - 'tile': name, 'sheet': the big image, 'bbox'
+            - 'stages': the stages passed ('crop', 'geometries', 'rasterize',
+            'dom', 'write')
+            - 'status': 'saved', 'skipped' or 'failed'
+            - 'files': file name -> {'sha1', 'size'} of the written files
+    '''
+
+    def __init__(self, dirTo, imageName, part):
+        '''
+            Reads the manifests of all earlier builds of the image (with any
+            split into columns), the latest line of a tile counts
+        '''
+        self.dirTo = dirTo
+        self.entries = {}
+        for file in glob.glob(dirTo + imageName + '_manifest_*.jsonl'):
+            with open(file) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # line cut by the interruption
+                        continue
+                    old = self.entries.get(entry['tile'])
+                    if old is None or old['time'] <= entry['time']:
+                        self.entries[entry['tile']] = entry
+
+        self.sheet = imageName
+        self.lock = threading.Lock()
+        self.file = open(dirTo + imageName + '_manifest_' + str(part) +
+                         '.jsonl', 'a')
+
+    def __intact(self, files):
+        '''
+            Whether the files are there as they were written
+        '''
+        for name, info in files.items():
+            path = os.path.join(self.dirTo, name)
+            if (not os.path.exists(path) or
+                    os.path.getsize(path) != info['size']):
+                return False
+            if MANIFEST_VERIFY:
+                with open(path, 'rb') as f:
+                    if hashlib.sha1(f.read()).hexdigest() != info['sha1']:
+                        return False
+        return True
+
+    def state(self, name):
+        '''
+            Parameters
+            ----------
+            name: string
+                - the tile name with its path, like ImageProcessor.process
+
+            Returns
+            -------
+            the state and the manifest entry of the tile:
+                - 'saved', 'skipped': finished
+                - 'dom': all files but the DOM are written
+                - None: the tile is built (again)
+        '''
+        entry = self.entries.get(os.path.basename(name))
+        if entry is None:
+            return None, None
+        if entry['status'] == 'skipped':
+            return 'skipped', entry
+        if not self.__intact(entry['files']):
+            return None, entry
+        if entry['status'] == 'saved':
+            return 'saved', entry
+        if 'write' in entry['stages'] and 'dom' not in entry['stages']:
+            return 'dom', entry
+        return None, entry
+
+    def record(self, tile, status, files=None):
+        '''
+            Appends the state of the tile to the manifest
+        '''
+        if files is None:
+            files = {}
+        entry = {'tile': os.path.basename(tile['name']), 'sheet': self.sheet,
+                 'bbox': list(tile['bbox']), 'stages': tile['stages'],
+                 'status': status, 'files': files, 'time': time.time()}
+        with self.lock:
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class TileFileWriter():
+    '''
+        class that saves the tiles of ImageProcessor as single files:
+        '<name>.tif', '<name>_bbox.txt', '<name>_dom.png', '<name>_edges.tif'
+        and for the 2nd net the groups, nothing and false data rasters
+    '''
+
+    def __writeFile(self, filename, data):
+        '''
+            Writes the bytes to the file
+
+            Returns
+            -------
+            the manifest entry of the file: name -> {'sha1', 'size'}
+        '''
+        out = open(filename, 'wb')
+        out.write(data)
+        out.close()
+        return {os.path.basename(filename): {
+            'sha1': hashlib.sha1(data).hexdigest(), 'size': len(data)}}
+
+    def __writeImage(self, filename, image):
+        '''
+            Encodes the image like cv2.imwrite and writes it
+        '''
+        ok, data = cv2.imencode(os.path.splitext(filename)[1], image)
+        assert ok, 'could not encode ' + filename
+        return self.__writeFile(filename, data.tobytes())
+
+    def __saveSmallerBBox(self, file, bbox):
+        '''
+            Saves the BBox for the previously produced smaller image
+
+            Parameters
+            ----------
+            file: string
+                - the path of the smaller image with its name
+                - like 'path/to/this/filename' without '.tif'
+
+            bbox: float[xmin, ymin, xmax, ymax]
+                - in meters to the (Coordinate System)
+        '''
+        assert len(bbox) == 4, 'wrong BBox argument size'
+        filename = file + BBOX_EXTENT
+        text = ''.join(str(value) + '\n' for value in bbox)
+        return self.__writeFile(filename, text.encode('utf-8'))
+
+    def write(self, tile):
+        '''
+            Saves the tile
+
+            Parameters
+            ----------
+            tile: dict
+                - 'name', 'bbox', 'image', 'dom' (PNG bytes), 'edges'
+                - for the 2nd net: 'groups', 'nothing', 'groups_f', 'edges_f'
+                - 'dom' may be None, if the WMS request failed
+
+            Returns
+            -------
+            the written files: name -> {'sha1', 'size'}
+        '''
+        name = tile['name']
+        files = self.__saveSmallerBBox(name, tile['bbox'])
+        if 'groups' in tile:
+            files.update(self.__writeImage(name + GROUPS_EXTENT + '.tif',
+                                           tile['groups']))
+            files.update(self.__writeImage(name + NO_DATA_AREA_EXTENT +
+                                           '.tif', tile['nothing']))
+            files.update(self.__writeImage(name + GROUPS_EXTENT + '_f.tif',
+                                           tile['groups_f']))
+            files.update(self.__writeImage(name + EDGES_EXTENT + '_f.tif',
+                                           tile['edges_f']))
+
+        files.update(self.__writeImage(name + '.tif', tile['image']))
+        if tile['dom'] is not None:
+            files.update(self.writeDOM(tile))
+        files.update(self.__writeImage(name + EDGES_EXTENT + '.tif',
+                                       tile['edges']))
+        return files
+
+    def writeDOM(self, tile):
+        '''
+            Saves the DOM (PNG bytes) of the tile
+        '''
+        return self.__writeFile(tile['name'] + DOM_EXTENT + '.png',
+                                tile['dom'])
+
+    def close(self):
+        return
+
+
+class ShardWriter():
+    '''
+        class that packs the tiles of ImageProcessor into a few HDF5 files
+        ('shards') instead of four or more small files per tile
+
+        every shard holds up to Params.SHARD_SIZE tiles in the datasets
+            'name': (N,) string
+            'bbox': (N, 4) float64
+            'image': (N, H, W, 3) uint8, BGR like cv2.imread
+            'dom': (N, H, W) uint8, 1st channel of the DOM PNG
+            'edges': (N, H, W) uint8
+            for the 2nd net also
+            'groups', 'groups_f': (N, H, W, 3) uint8
+            'nothing', 'edges_f': (N, H, W) uint8
+        each tile is one chunk, compressed with lzf
+    '''
+
+    def __init__(self, prefix, shardSize=SHARD_SIZE):
+        '''
+            Parameters
+            ----------
+            prefix: string
+                - the shards are saved as '<prefix>_000.h5', ...
+            shardSize: int
+                - maximum number of tiles per shard
+        '''
+        self.prefix = prefix
+        self.shardSize = shardSize
+        self.shardNumber = 0
+        self.shard = None
+        self.count = 0
+
+    def __create(self, key, value):
+        value = np.asarray(value)
+        self.shard.create_dataset(key, shape=(0,) + value.shape,
+                                  maxshape=(None,) + value.shape,
+                                  chunks=(1,) + value.shape, dtype=np.uint8,
+                                  compression='lzf')
+
+    def __append(self, key, value):
+        dataset = self.shard[key]
+        dataset.resize(self.count + 1, axis=0)
+        dataset[self.count] = value
+
+    def write(self, tile):
+        '''
+            Appends the tile to the current shard, see TileFileWriter.write
+        '''
+        if self.shard is not None and self.count == self.shardSize:
+            self.close()
+        dom = cv2.imdecode(np.frombuffer(tile['dom'], np.uint8),
+                           cv2.IMREAD_COLOR)[:, :, 0]
+        arrays = {'image': tile['image'], 'dom': dom}
+        for key in ['edges', 'groups', 'nothing', 'groups_f', 'edges_f']:
+            if key in tile:
+                arrays[key] = np.asarray(tile[key]).astype(np.uint8)
+        if 'nothing' in arrays:
+            arrays['nothing'] = arrays['nothing'][:, :, 0]
+
+        if self.shard is None:
+            filename = self.prefix + '_{:03d}.h5'.format(self.shardNumber)
+            self.shard = h5py.File(filename, 'w')
+            self.shard.create_dataset('name', shape=(0,), maxshape=(None,),
+                                      dtype=h5py.special_dtype(vlen=str))
+            self.shard.create_dataset('bbox', shape=(0, 4),
+                                      maxshape=(None, 4), dtype=np.float64)
+            for key in arrays:
+                self.__create(key, arrays[key])
+            self.count = 0
+
+        self.__append('name', os.path.basename(tile['name']))
+        self.__append('bbox', tile['bbox'])
+        for key in arrays:
+            self.__append(key, arrays[key])
+        self.count += 1
+
+    def close(self):
+        '''
+            Closes the current shard, the next tile starts a new one
+        '''
+        if self.shard is None:
+            return
+        self.shard.close()
+        self.shard = None
+        self.shardNumber += 1
 
 
 def openImageFile(file):
@@ -196,9 +838,98 @@ def openEdgeImage(file):
 #        imsave(imName + 'f' + EDGES_EXTENT + '.tif', em_f)
 
 
+def getImageShape(file):
+    '''
+        Reads the pixel dimensions of the image without loading the pixels
+
+        Parameters
+        ----------
+        file: string
+            - like 'path/to/this/filename.tif'
+
+        Returns
+        -------
+        (rows, columns) of the image
+    '''
+    return WindowedImage(file).shape[:2]
+
+
+def __processImagePart(task):
+    '''
+        Produces the smaller images for some tile columns of one big image,
+        runs in a worker process of makeSmallerImages
+
+        Parameters
+        ----------
+        task: tuple
+            - (file, dirTo, size_wanted, forTraining, for2ndNet, columns,
+            storage)
+
+        Returns
+        -------
+        the report of ImageProcessor.process, all tiles of the columns
+        counted as failed if the big image fails as a whole
+    '''
+    (file, dirTo, size_wanted, forTraining, for2ndNet, columns,
+     storage) = task
+    try:
+        imageProcessor = ImageProcessor(file)
+        return imageProcessor.process(dirTo=dirTo, size_wanted=size_wanted,
+                                      forTraining=forTraining,
+                                      for2ndNet=for2ndNet, columns=columns,
+                                      storage=storage)
+    except Exception as e:
+        # the other images of the pool go on
+        print(os.path.basename(file) + ' columns ' + str(columns[0]) + '-' +
+              str(columns[-1]) + ' failed, ' + str(e))
+        name = re.search(r'(dop20.*).tif', file)
+        name = (name.group(1) if name is not None else
+                os.path.splitext(os.path.basename(file))[0])
+        ranY = int(getImageShape(file)[1] / size_wanted[1])
+        return {'image': name, 'saved': 0, 'skipped': 0,
+                'failed': len(columns) * ranY, 'resumed': 0}
+
+
+def __formatCounts(counts):
+    '''
+        'x saved, y skipped, z failed (w from earlier builds)'
+    '''
+    return (str(counts['saved']) + ' saved, ' + str(counts['skipped']) +
+            ' skipped, ' + str(counts['failed']) + ' failed (' +
+            str(counts['resumed']) + ' from earlier builds)')
+
+
+def __mergeReports(reports):
+    '''
+        Sums up the reports of ImageProcessor.process per big image and
+        prints them
+
+        Returns
+        -------
+        dict: image name -> {'saved', 'skipped', 'failed', 'resumed': int}
+    '''
+    merged = {}
+    for report in reports:
+        counts = merged.setdefault(report['image'], {'saved': 0,
+                                                     'skipped': 0,
+                                                     'failed': 0,
+                                                     'resumed': 0})
+        for key in counts:
+            counts[key] += report.get(key, 0)
+
+    total = {'saved': 0, 'skipped': 0, 'failed': 0, 'resumed': 0}
+    for name in sorted(merged):
+        counts = merged[name]
+        print(name + ':\t' + __formatCounts(counts))
+        for key in total:
+            total[key] += counts[key]
+    print(str(len(merged)) + ' images:\t' + __formatCounts(total))
+    return merged
+
+
 def makeSmallerImages(path, dirTo=DOP_PATH + SMALL_DOP_TRAIN,
                       size_wanted=[IMAGE_SIZE_SMALL], forTraining=False,
-                      for2ndNet=False):
+                      for2ndNet=False, workers=WORKERS, storage=STORAGE):
     '''
         Reads the Tif-Images from the given path and produce smaller images.
         The belonging Edge Maps will also be produced
@@ -216,8 +947,33 @@ def makeSmallerImages(path, dirTo=DOP_PATH + SMALL_DOP_TRAIN,
             - minimum size 1
 
         forTraining: boolean
+
+        for2ndNet: boolean
+            - also produce the groups, nothing and false data rasters
+
+        workers: int
+            - number of worker processes (ProcessPoolExecutor), 1 produces
+            the images in this process
+            - every big image is split into 'workers' column ranges, so even
+            a single big image keeps all workers busy
+            - each of them runs the tile pipeline of ImageProcessor.process
+            with its own threads
+
+        storage: string
+            - 'files': single files per tile, resumable with the manifest
+            - 'hdf5': HDF5 shards per column range, built anew every run
+            - see ImageProcessor.process
+
+        Returns
+        -------
+        the merged report, also printed per image and in total:
+        image name -> {'saved', 'skipped', 'failed', 'resumed': int}
+            - 'failed' includes all tiles of a column range whose big image
+            failed as a whole
+            - 'resumed': tiles finished by earlier builds
     '''
     assert len(size_wanted) >= 1, 'no image size'
+    assert workers >= 1, 'need at least one worker'
     x = size_wanted[0]
     y = size_wanted[0]
     if len(size_wanted) >= 2:
@@ -226,13 +982,25 @@ def makeSmallerImages(path, dirTo=DOP_PATH + SMALL_DOP_TRAIN,
 
     Path(dirTo).mkdir(exist_ok=True)
     filenames = glob.glob(path + '*.tif')
+    filenames = [f for f in filenames if EDGES_EXTENT not in f]
+
+    tasks = []
     for f in filenames:
-        if EDGES_EXTENT in f:
-            continue
-        imageProcessor = ImageProcessor(f)
-        imageProcessor.process(dirTo=dirTo, size_wanted=[x, y],
-                               forTraining=forTraining, for2ndNet=for2ndNet)
+        ranX = int(getImageShape(f)[0] / x)
+        step = max(int(np.ceil(ranX / workers)), 1)
+        for start in range(0, ranX, step):
+            columns = range(start, min(start + step, ranX))
+            tasks.append((f, dirTo, [x, y], forTraining, for2ndNet,
+                          columns, storage))
+    if workers == 1:
+        reports = [__processImagePart(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            reports = list(executor.map(__processImagePart, tasks))
+
+    report = __mergeReports(reports)
     print('Finished producing smaller images.')
+    return report
 
 
 def plotImageList(im_list, title_list, gray_list):
@@ -295,7 +1063,8 @@ def produceImageList(directory, fileName, withEdgeMaps=True):
     text_file = open(directory + fileName, "w")
     for file in filenames:
         # generated edge maps are skipped
-        if DOM_EXTENT in file or EDGES_EXTENT in file:
+        if (DOM_EXTENT in file or EDGES_EXTENT in file or
+                NO_DATA_AREA_EXTENT in file):
             continue
 
         text_file.write(file[skip:])
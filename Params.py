@@ -34,3 +34,58 @@ SOBEL_ROBERTS_FOLDER = 'sobel_roberts/'
 WFS_FELDBLOCK = 'https://www.geodaten-mv.de/dienste/gdimv_feldblock_wfs'
 # WMS for Digitales Oberflächenmodell
 WMS_DOM = 'https://www.geodaten-mv.de/dienste/dom_wms'
+# number of worker processes for producing the smaller images
+# (1 = process everything in the calling process)
+WORKERS = 1
+# fetch the WFS geometries once for all tiles of a big image and clip them
+# locally, instead of asking the WFS for every tile
+WFS_BULK_QUERY = True
+# directory for the cached WFS responses (None = no cache)
+WFS_CACHE_DIR = DOP_PATH + 'wfs_cache/'
+# maximum size of the WFS cache in bytes, least recently used responses are
+# deleted first
+WFS_CACHE_SIZE = 2 * 1024 ** 3
+# only answer WFS requests from the cache, never connect to the WFS
+WFS_OFFLINE = False
+# number of parallel requests to the WMS
+WMS_WORKERS = 8
+# number of retries for a failed WMS request, waiting 1, 2, 4, ... seconds
+WMS_RETRIES = 3
+# timeout for a WMS request in seconds
+WMS_TIMEOUT = 60
+# directory for the cached GetCapabilities documents of the WFS and WMS
+CAPABILITIES_CACHE_DIR = DOP_PATH + 'capabilities_cache/'
+# seconds until a cached GetCapabilities document is fetched again
+CAPABILITIES_MAX_AGE = 24 * 60 * 60
+# how the smaller images are stored: 'files' (single files per tile) or
+# 'hdf5' (packed into shards, see ImageHandling.ShardWriter)
+STORAGE = 'files'
+# maximum number of tiles per HDF5 shard
+SHARD_SIZE = 1000
+# maximum number of tiles waiting between two stages of the tile pipeline
+# of ImageHandling.ImageProcessor
+PIPELINE_QUEUE_SIZE = 16
+# worker threads per stage of the tile pipeline (the windows of the big
+# image are cropped in the calling thread, HDF5 shards get one writer)
+PIPELINE_GEOMETRY_WORKERS = 2
+PIPELINE_RASTER_WORKERS = 2
+PIPELINE_DOM_WORKERS = 8
+PIPELINE_WRITE_WORKERS = 2
+# record every tile of a build with 'files' storage in a manifest, so an
+# interrupted build skips the finished tiles (see ImageHandling.BuildManifest)
+MANIFEST = True
+# compare the checksums of the files of finished tiles when resuming,
+# otherwise just their sizes
+MANIFEST_VERIFY = False
+# outputFormat of the WFS GetFeature requests: 'auto' (GeoJSON if the WFS
+# offers it, otherwise GML), 'GML' or a format offered by the WFS
+WFS_OUTPUT_FORMAT = 'auto'
+# number of features per WFS GetFeature request (maxFeatures/startIndex),
+# bigger bboxes are fetched page by page if the WFS advertises result paging
+# (None = everything at once)
+WFS_PAGE_SIZE = 5000
+# most pages per FeatureType and bbox if the WFS doesn't state numberMatched
+WFS_MAX_PAGES = 1000
+# property to sort the pages of a FeatureType by, the first property of its
+# schema if the FeatureType is not given here
+WFS_SORT_BY = {}
@@ -0,0 +1,103 @@
+from owslib.wfs import WebFeatureService
+from pathlib import Path
+import hashlib
+from xml.etree import ElementTree as ET
+import os
+import threading
+import time
+import requests
+import Params
+
+
+# service clients by (service, url, version), created on first use
+SERVICES = {}
+SERVICES_LOCK = threading.Lock()
+
+
+def __getCapabilities(service, url, version):
+    '''
+        Gets the GetCapabilities document of the service, from the
+        capabilities cache if it was fetched within the last
+        Params.CAPABILITIES_MAX_AGE seconds
+
+        Parameters
+        ----------
+        service: string
+            - 'WFS' or 'WMS'
+        url: string
+        version: string
+
+        Returns
+        -------
+        the capabilities XML (bytes)
+    '''
+    directory = Params.CAPABILITIES_CACHE_DIR
+    key = '|'.join([service, url, version]).encode('utf-8')
+    path = os.path.join(directory, hashlib.sha1(key).hexdigest() + '.xml')
+    if (os.path.exists(path) and
+            time.time() - os.path.getmtime(path) <
+            Params.CAPABILITIES_MAX_AGE):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    response = requests.get(url, params={'service': service,
+                                         'request': 'GetCapabilities',
+                                         'version': version},
+                            timeout=Params.WMS_TIMEOUT)
+    response.raise_for_status()
+    xml = response.content
+
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    # other processes may read the cache at the same time
+    tmp = path + '.' + str(os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(xml)
+    os.replace(tmp, path)
+    return xml
+
+
+def __getService(service, url, version):
+    '''
+        Returns the shared client for the service, creating it with the
+        cached capabilities on first use
+    '''
+    key = (service, url, version)
+    with SERVICES_LOCK:
+        if key not in SERVICES:
+            xml = __getCapabilities(service, url, version)
+            assert service == 'WFS', 'no client for ' + service
+            client = WebFeatureService(url=url, version=version, xml=xml)
+            assert client is not None, "Could not connect to " + service
+            SERVICES[key] = client
+        return SERVICES[key]
+
+
+def getWFS(url=Params.WFS_FELDBLOCK, version='1.1.0'):
+    '''
+        Returns the shared WebFeatureService for the url
+    '''
+    return __getService('WFS', url, version)
+
+
+def supportsResultPaging(url=Params.WFS_FELDBLOCK, version='1.1.0'):
+    '''
+        Whether the WFS advertises result paging (the OWS constraint
+        ImplementsResultPaging) in the capabilities of the version the
+        features are requested with
+
+        Returns
+        -------
+        bool, False if the capabilities can't be read
+    '''
+    try:
+        root = ET.fromstring(__getCapabilities('WFS', url, version))
+    except Exception:
+        return False
+    for constraint in root.iter():
+        if (constraint.tag.endswith('}Constraint') and
+                constraint.get('name') == 'ImplementsResultPaging'):
+            for value in constraint.iter():
+                if (value.tag.endswith('}DefaultValue') and
+                        (value.text or '').strip().upper() == 'TRUE'):
+                    return True
+    return False
@@ -1,19 +1,252 @@
-from owslib.wfs import WebFeatureService as WFS
 from owslib.util import ResponseWrapper
 from six.moves import cStringIO
 from xml.etree import ElementTree as ET
 from osgeo import ogr
+from pathlib import Path
+import hashlib
+import io
+import json
+import math
+import os
 import re
+import struct
+import tempfile
+import timeit
+import numpy as np
 import Params
+import ServiceHandling as services
 import random
 
 
+# the WFSCache shared by all Feldblock_WFS of this process
+CACHE = None
+# namespace of the GML geometries
+GML = '{http://www.opengis.net/gml}'
+# property to sort the pages of a FeatureType by, from its schema
+SORT_PROPERTIES = {}
+# coordinate system of the geometries (the DOPs)
+SRS_NAME = 'EPSG:5650'
+# GetFeature outputFormats for GeoJSON, in order of preference
+JSON_FORMATS = ['application/json', 'application/geo+json',
+                'application/vnd.geo+json', 'json', 'geojson']
+
+
+class WFSCache():
+    '''
+        content addressed on-disk cache for raw WFS responses, the least
+        recently used responses are deleted if the cache grows beyond maxSize
+    '''
+
+    def __init__(self, directory=Params.WFS_CACHE_DIR,
+                 maxSize=Params.WFS_CACHE_SIZE):
+        self.directory = directory
+        self.maxSize = maxSize
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        self.size = sum(f.stat().st_size for f in self.__entries())
+
+    def __entries(self):
+        return [f for f in Path(self.directory).iterdir()
+                if f.suffix == '.gml']
+
+    def __path(self, key):
+        return os.path.join(self.directory, key + '.gml')
+
+    def key(self, *parts):
+        '''
+            Builds the key for the response to a request
+
+            Parameters
+            ----------
+            parts: everything that identifies the request, like url, WFS
+            version, layer and bbox
+
+            Returns
+            -------
+            the hex digest for the parts
+        '''
+        text = '|'.join(str(p) for p in parts)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        '''
+            Returns the cached response (bytes) for the key, None if there is
+            none
+        '''
+        path = self.__path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        # the modification time is the last usage for the eviction
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # evicted by another worker since, the data is read already
+            pass
+        return data
+
+    def put(self, key, data):
+        '''
+            Saves the response (bytes) for the key, except for service
+            exception reports
+        '''
+        # a server error must not be answered from the cache forever
+        if isExceptionReport(data):
+            return
+        path = self.__path(key)
+        # other processes and threads may read or write the same key
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp',
+                                         delete=False) as f:
+            f.write(data)
+        os.replace(f.name, path)
+        self.size += len(data)
+        if self.size > self.maxSize:
+            self.__evict()
+
+    def __evict(self):
+        '''
+            Deletes the least recently used responses until the cache is
+            smaller than maxSize
+        '''
+        entries = []
+        for f in self.__entries():
+            try:
+                stat = f.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, f))
+        entries.sort(key=lambda e: e[0])
+        self.size = sum(e[1] for e in entries)
+        for mtime, size, f in entries:
+            if self.size <= self.maxSize:
+                break
+            try:
+                f.unlink()
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+
+class STRtree():
+    '''
+        Sort-Tile-Recursive packed R-tree over the envelopes of OGR
+        geometries, to find the geometries whose envelope intersects a bbox
+        without testing all of them
+    '''
+
+    def __init__(self, geometries, nodeCapacity=10):
+        '''
+            Parameters
+            ----------
+            geometries: Geometry[]
+                - the indexed geometries, None values are left out
+            nodeCapacity: int
+                - maximum number of children per node
+        '''
+        assert nodeCapacity >= 2, 'node capacity too small'
+        self.geometries = geometries
+        self.nodeCapacity = nodeCapacity
+
+        # entries: (xmin, ymin, xmax, ymax, index or child entries)
+        entries = []
+        for i, g in enumerate(geometries):
+            if g is None:
+                continue
+            entries.append(tuple(envelope2BBox(g)) + (i,))
+        self.leaves = True
+        while len(entries) > nodeCapacity:
+            entries = self.__pack(entries)
+            self.leaves = False
+        self.root = entries
+
+    def __pack(self, entries):
+        '''
+            Groups the entries into nodes of nodeCapacity entries: the entries
+            are sorted into vertical slices by x, within each slice by y
+        '''
+        cap = self.nodeCapacity
+        nodeCount = -(-len(entries) // cap)
+        sliceCount = int(math.ceil(math.sqrt(nodeCount)))
+        sliceSize = sliceCount * cap
+
+        entries = sorted(entries, key=lambda e: e[0] + e[2])
+        nodes = []
+        for s in range(0, len(entries), sliceSize):
+            vSlice = sorted(entries[s:s + sliceSize],
+                            key=lambda e: e[1] + e[3])
+            for n in range(0, len(vSlice), cap):
+                children = vSlice[n:n + cap]
+                nodes.append((min(c[0] for c in children),
+                              min(c[1] for c in children),
+                              max(c[2] for c in children),
+                              max(c[3] for c in children),
+                              children))
+        return nodes
+
+    def query(self, bbox):
+        '''
+            Finds the geometries whose envelope intersects the bbox
+
+            Parameters
+            ----------
+            bbox: float[xmin, ymin, xmax, ymax]
+
+            Returns
+            -------
+            the indices of the candidate geometries in ascending order
+        '''
+        xmin, ymin, xmax, ymax = bbox
+        result = []
+        # (entries, whether the entries are leaves)
+        stack = [(self.root, self.leaves)]
+        while stack:
+            entries, leaves = stack.pop()
+            for e in entries:
+                if (e[0] > xmax or e[2] < xmin or e[1] > ymax or
+                        e[3] < ymin):
+                    continue
+                if leaves:
+                    result.append(e[4])
+                else:
+                    # children of the nodes on the lowest level are leaves
+                    stack.append((e[4], not isinstance(e[4][0][4], list)))
+        result.sort()
+        return result
+
+    def queryGeometries(self, bbox):
+        '''
+            Finds the geometries whose envelope intersects the bbox, in the
+            order of the indexed list
+        '''
+        return [self.geometries[i] for i in self.query(bbox)]
+
+
+def getCache():
+    '''
+        Returns the WFSCache of this process, None if Params.WFS_CACHE_DIR is
+        None
+    '''
+    global CACHE
+    if CACHE is None and Params.WFS_CACHE_DIR is not None:
+        CACHE = WFSCache()
+    return CACHE
+
+
 class Feldblock_WFS():
     '''
         class for usage of the Feldblock WFS for Mecklenburg-Western-Pommerania
     '''
 
-    def __init__(self):
+    def __init__(self, url=Params.WFS_FELDBLOCK, offline=Params.WFS_OFFLINE):
+        '''
+            Parameters
+            ----------
+            url: string
+                - the WFS to use, e.g. a local stand-in server for tests
+            offline: boolean
+                - whether the requests are only answered from the cache
+        '''
         self.mv = '{http://www.geodaten-mv.de/dienste/gdimv_feldblock_wfs}'
         self.gml = '{http://www.opengis.net/gml}'
 
@@ -22,16 +255,80 @@ class Feldblock_WFS():
         self.nbf_layer = 'mv:nbf_flaechen'
         self.layers = [self.fb_layer, self.le_layer, self.nbf_layer]
 
-        self.wfsUrl = Params.WFS_FELDBLOCK
+        self.wfsUrl = url
         self.wfsVersion = '1.1.0'
 
-        self.wfs = WFS(url=self.wfsUrl, version=self.wfsVersion)
-        assert self.wfs is not None, "Could not connect to WFS"
+        self.offline = offline
+        # None: GML, the format of the WFS 1.1.0 default
+        self.outputFormat = None
+        self.outputFormatKnown = False
+        # whether the WFS advertises paging, looked up on the first request
+        self.paging = None
+        self.cache = getCache()
+        assert self.cache is not None or not offline, \
+            "Offline mode needs the WFS cache"
+        # the WFS itself is just connected to on the first request
         # __printWFSInfos(wfs)
 
-        random.seed(5)
+        # geometries of all layers fetched at once for a bigger bbox
+        self.prefetchedBBox = None
+        self.prefetched = {}
+        self.prefetchedIndex = {}
+
+        # the manipulations of findGeometriesByGroup without a seed
+        self.random = random.Random(5)
+
+    @property
+    def wfs(self):
+        '''
+            the shared WebFeatureService, see ServiceHandling.getWFS
+        '''
+        return services.getWFS(self.wfsUrl, self.wfsVersion)
+
+    def __getOutputFormat(self):
+        '''
+            The outputFormat for the GetFeature requests, see
+            Params.WFS_OUTPUT_FORMAT, looked up in the capabilities once
+
+            Returns
+            -------
+            the format string, None for GML
+        '''
+        if not self.outputFormatKnown:
+            if Params.WFS_OUTPUT_FORMAT == 'auto':
+                self.outputFormat = detectOutputFormat(self.wfs)
+            elif Params.WFS_OUTPUT_FORMAT != 'GML':
+                self.outputFormat = Params.WFS_OUTPUT_FORMAT
+            self.outputFormatKnown = True
+        return self.outputFormat
+
+    def __getPaging(self):
+        '''
+            Whether the features are requested page by page: with a
+            Params.WFS_PAGE_SIZE and if the WFS advertises result paging,
+            see ServiceHandling.supportsResultPaging
+        '''
+        if self.paging is None:
+            self.paging = bool(Params.WFS_PAGE_SIZE and
+                               services.supportsResultPaging(self.wfsUrl,
+                                                             self.wfsVersion))
+        return self.paging
+
+    def __getSortBy(self, typeName):
+        '''
+            The property the pages are sorted by, so that their order stays
+            the same between the requests: Params.WFS_SORT_BY[typeName] or
+            the first property of the FeatureType
+        '''
+        if typeName in Params.WFS_SORT_BY:
+            return Params.WFS_SORT_BY[typeName]
+        key = (self.wfsUrl, typeName)
+        if key not in SORT_PROPERTIES:
+            schema = self.wfs.get_schema(typeName)
+            SORT_PROPERTIES[key] = list(schema['properties'])[0]
+        return SORT_PROPERTIES[key]
 
-    def __getFeatures(self, typeName):
+    def __getFeatures(self, typeName, bbox, start=0):
         '''
             Gets the Features with the WFS
 
@@ -40,13 +337,85 @@ class Feldblock_WFS():
             typeName: string
                 - name of the FeatureType to search for
             bbox: float[xmin, ymin, xmax, ymax]
+            start: int
+                - index of the first feature of the page
+
+            Returns
+            -------
+            the response of the WFS (bytes, GML or GeoJSON), taken from the
+            cache if it was requested before, and whether it is a page (False:
+            all features at once)
         '''
-        feat = self.wfs.getfeature(typename=typeName, bbox=self.bbox)
+        # the capabilities are just needed for a request, until then any
+        # cached format will do
+        if self.outputFormatKnown:
+            formats = [self.outputFormat]
+        elif Params.WFS_OUTPUT_FORMAT == 'GML':
+            formats = [None]
+        elif Params.WFS_OUTPUT_FORMAT != 'auto':
+            formats = [Params.WFS_OUTPUT_FORMAT]
+        else:
+            formats = [None] + JSON_FORMATS
+        # same for paging, a complete response ends it at once
+        pagings = [True, False] if start == 0 else [True]
+        if self.paging is not None:
+            pagings = [self.paging]
+        if not Params.WFS_PAGE_SIZE:
+            pagings = [False]
+
+        if self.cache is not None:
+            for outputFormat in formats:
+                for paged in pagings:
+                    key = self.__cacheKey(typeName, bbox, outputFormat,
+                                          start if paged else None)
+                    feat = self.cache.get(key)
+                    if feat is not None:
+                        return feat, paged
+        if self.offline:
+            raise RuntimeError('No cached WFS response for ' + typeName +
+                               ' ' + str(bbox) + ' from ' + str(start) +
+                               ' in offline mode')
+
+        outputFormat = self.__getOutputFormat()
+        paged = self.__getPaging()
+        params = {'typename': typeName, 'bbox': bbox}
+        if outputFormat is not None:
+            # GeoJSON would be in CRS84 otherwise
+            params['outputFormat'] = outputFormat
+            params['srsname'] = SRS_NAME
+        if paged:
+            params['maxfeatures'] = Params.WFS_PAGE_SIZE
+            params['startindex'] = start
+            params['sortby'] = [self.__getSortBy(typeName)]
+        elif start > 0:
+            # all features came with the first request
+            return b'', False
+        feat = self.wfs.getfeature(**params)
         if isinstance(feat, ResponseWrapper):
             feat = feat.read()
         if isinstance(feat, cStringIO):
             feat = feat.getvalue()
-        return feat
+        if isinstance(feat, str):
+            feat = feat.encode('utf-8')
+
+        if self.cache is not None:
+            self.cache.put(self.__cacheKey(typeName, bbox, outputFormat,
+                                           start if paged else None), feat)
+        return feat, paged
+
+    def __cacheKey(self, typeName, bbox, outputFormat, start):
+        '''
+            The cache key of the GetFeature request, unpaged (start None) GML
+            responses keep the keys they had before paging and other formats
+            were used
+        '''
+        parts = [self.wfsUrl, self.wfsVersion, typeName,
+                 ','.join('%.3f' % v for v in bbox)]
+        if outputFormat is not None:
+            parts += [outputFormat, SRS_NAME]
+        if start is not None:
+            parts.append('features %d + %d' % (start, Params.WFS_PAGE_SIZE))
+        return self.cache.key(*parts)
 
     def __printWFSInfos(self):
         print('Titel:\t' + self.wfs.identification.title)
@@ -55,45 +424,166 @@ class Feldblock_WFS():
         print('FetaureTypes:\t' + str(list(self.wfs.contents)))
         print('GetCapabilities:\t' + self.wfs.getcapabilities().geturl())
 
-    def __findGeometries(self, feature_xml):
+    def __iterFeatures(self, feature_xml, bbox):
         '''
-            Find the Geometries within the XML-string
+            The features of a response of our WFS, see iterGMLFeatures and
+            iterGeoJSONFeatures
 
             Parameters
             ----------
-            feature_xml: string
-                - the returned XML string from our WFS containing the
-                geometries
+            feature_xml: bytes
+                - GML or GeoJSON
+            bbox: float[xmin, ymin, xmax, ymax]
+                - the bbox of the request
 
             Returns
             -------
-            Geometry[] containing the geometries found
+            generator of (feature id, Geometry[]) per feature
         '''
-        root = ET.fromstring(feature_xml)
-        # print(root.tag)
-        geometries = []
-        for child in root.findall(self.gml + 'featureMember'):
-            for cchild in child[0].find(self.mv + 'the_geom')[0][0]:
-                # print (cchild.text)
-                geom_gml = str(ET.tostring(cchild, method='xml'))
-                # print("String Ding:\n",geom_gml)
+        # GeoJSON, if the WFS answered in it, otherwise GML or an exception
+        if feature_xml.lstrip()[:1] == b'{':
+            return iterGeoJSONFeatures(feature_xml, bbox)
+        if not feature_xml:
+            return iter([])
+        return iterGMLFeatures(feature_xml, self.mv + 'the_geom')
 
-                # Start
-                geom_gml = re.sub(r"b'<", "<", geom_gml)
-                # Middle
-                geom_gml = re.sub(r">[^>^<]+<^/", "><", geom_gml)
-                # End
-                geom_gml = re.sub(r">[^>]*'", ">", geom_gml)
+    def iterGeometries(self, layer, bbox):
+        '''
+            Gets the Geometries of the layer within the bbox from the WFS,
+            page by page if the WFS supports it, so just one page of the
+            response is held at a time
 
-                geom = ogr.CreateGeometryFromGML(geom_gml)
-                if geom is None:
-                    print("Problem with GML:\n", geom_gml)
-                    print("Geometry:\n", geom)
-                geometries.append(geom)
-        # print(len(geometries), " geometries in gml")
-        return geometries
+            The next page starts after the features received so far (a WFS
+            may send fewer than asked for), the paging ends with an empty
+            page, after the numberMatched of the first page, after as many
+            pages as numberMatched needs (Params.WFS_MAX_PAGES without it) or
+            with a page repeating the one before (a WFS ignoring
+            startIndex), compared by the feature ids or, for features
+            without one, by their geometries
+
+            Parameters
+            ----------
+            layer: string
+                - name of the FeatureType to search for
+            bbox: float[xmin, ymin, xmax, ymax]
+
+            Returns
+            -------
+            generator of the Geometries
+        '''
+        bbox = list(bbox)
+        start = 0
+        pages = 0
+        maxPages = Params.WFS_MAX_PAGES
+        matched = None
+        previousPage = None
+        previous = set()
+        while True:
+            feat, paged = self.__getFeatures(layer, bbox, start)
+            page = hashlib.sha1(feat).digest()
+            if page == previousPage:
+                print('WFS repeats the page before ' + str(start) + ' of ' +
+                      layer + ', paging stopped')
+                return
+            if pages == 0 and paged:
+                matched = numberMatched(feat)
+            keys = set()
+            try:
+                for featureId, geometries in self.__iterFeatures(feat, bbox):
+                    if featureId is None:
+                        featureId = hashlib.sha1(b''.join(
+                            g.ExportToWkb() for g in geometries)).digest()
+                    if featureId in previous:
+                        print('WFS repeats the features before ' +
+                              str(start) + ' of ' + layer +
+                              ', paging stopped')
+                        return
+                    keys.add(featureId)
+                    start += 1
+                    for geom in geometries:
+                        yield geom
+            except ValueError as e:
+                # GeoJSON in another CRS fails before its first geometry,
+                # GML is always in the srsName
+                if (pages > 0 or self.outputFormat is None or
+                        feat.lstrip()[:1] != b'{'):
+                    raise
+                print(str(e) + ', using GML')
+                self.outputFormat = None
+                self.outputFormatKnown = True
+                start = 0
+                continue
+            pages += 1
+            if not paged or not keys:
+                return
+            if matched is not None:
+                if start >= matched:
+                    return
+                if pages == 1:
+                    # the WFS may limit the page size below WFS_PAGE_SIZE
+                    maxPages = matched // len(keys) + 1
+            if pages >= maxPages:
+                print('WFS paging of ' + layer + ' stopped after ' +
+                      str(pages) + ' pages')
+                return
+            previousPage = page
+            previous = keys
+
+    def __getGeometries(self, layer):
+        '''
+            Gets the Geometries of the layer within self.bbox, from the
+            prefetched geometries if self.bbox lies within the prefetched
+            bbox, otherwise with a request to the WFS
+
+            Parameters
+            ----------
+            layer: string
+                - name of the FeatureType to search for
+
+            Returns
+            -------
+            Geometry[] containing the geometries intersecting the bbox
+        '''
+        if (self.prefetchedBBox is None or
+                not bboxContains(self.prefetchedBBox, self.bbox)):
+            return list(self.iterGeometries(layer, self.bbox))
+        bboxPolygon = maxMin2Polygon(self.bbox)
+        candidates = self.prefetchedIndex[layer].queryGeometries(self.bbox)
+        return [g for g in candidates if g.Intersects(bboxPolygon)]
 
-    def __manipulate(self):
+    def prefetch(self, bbox):
+        '''
+            Fetches the Geometries of all layers within the BBox with one
+            request (per page) per layer. findGeometries and
+            findGeometriesByGroup take the geometries for any bbox within
+            this one from these, without asking the WFS again
+
+            Parameters
+            ----------
+            bbox: float[xmin, ymin, xmax, ymax]
+                - e.g. the bbox of a whole big image
+        '''
+        assert len(bbox) == 4, "BBox needs exactly 4 values"
+
+        self.bbox = bbox
+        self.prefetched = {}
+        self.prefetchedIndex = {}
+        for layer in self.layers:
+            self.prefetched[layer] = list(self.iterGeometries(layer, bbox))
+            self.prefetchedIndex[layer] = STRtree(self.prefetched[layer])
+        self.prefetchedBBox = list(bbox)
+
+    def share(self, other):
+        '''
+            Takes over the prefetched geometries of the other Feldblock_WFS.
+            They are only read, so Feldblock_WFS objects of several threads
+            can share them
+        '''
+        self.prefetchedBBox = other.prefetchedBBox
+        self.prefetched = other.prefetched
+        self.prefetchedIndex = other.prefetchedIndex
+
+    def __manipulate(self, rng):
         '''
             Manipulates the lists given
             one of the following scenarios will happen:
@@ -102,10 +592,18 @@ class Feldblock_WFS():
                 specified area will be deleted from the other layers
             the scenario is randomly chosen, but if #1 is not possible #2 will
             happen
+
+            Parameters
+            ----------
+            rng: random.Random
+                - the random numbers of this manipulation
         '''
+        # just FBs whose envelope intersects can be united to one POLYGON
+        fbIndex = STRtree(self.fb)
+
         # scenario 1: LE or NBF absorbed
         for element in self.nbf:
-            for geom in self.fb:
+            for geom in fbIndex.queryGeometries(envelope2BBox(element)):
                 union = geom.Union(element)
                 if union.GetGeometryName() == 'POLYGON':
                     self.nbf.remove(element)
@@ -114,7 +612,7 @@ class Feldblock_WFS():
                     return
 
         for element in self.le:
-            for geom in self.fb:
+            for geom in fbIndex.queryGeometries(envelope2BBox(element)):
                 union = geom.Union(element)
                 if union.GetGeometryName() == 'POLYGON':
                     self.le.remove(element)
@@ -124,8 +622,8 @@ class Feldblock_WFS():
 
         # scenario 2: random Polygon added
         xmin, ymin, xmax, ymax = self.bbox
-        x = [(xmax - xmin) * random.random() + xmin for i in [0, 1, 2]]
-        y = [(ymax - ymin) * random.random() + ymin for i in [0, 1, 2]]
+        x = [(xmax - xmin) * rng.random() + xmin for i in [0, 1, 2]]
+        y = [(ymax - ymin) * rng.random() + ymin for i in [0, 1, 2]]
         ring = ogr.Geometry(ogr.wkbLinearRing)
         ring.AddPoint(x[0], y[0])
         ring.AddPoint(x[1], y[1])
@@ -134,7 +632,7 @@ class Feldblock_WFS():
 
         polygon = ogr.Geometry(ogr.wkbPolygon)
         polygon.AddGeometry(ring)
-        for feldblock in self.fb:
+        for feldblock in fbIndex.queryGeometries(envelope2BBox(polygon)):
             intersection = polygon.Intersection(feldblock)
             if not intersection.IsEmpty():
                 if intersection.GetGeometryName() == 'POLYGON':
@@ -143,7 +641,7 @@ class Feldblock_WFS():
                     difference = feldblock.Difference(g)
                     self.fb.remove(feldblock)
                     self.fb.append(difference)
-                    rand = random.random()
+                    rand = rng.random()
                     if rand < 1 / 3:
                         self.le.append(g)
                     if rand >= 2 / 3:
@@ -173,19 +671,22 @@ class Feldblock_WFS():
         if len(geometryList) == 0:
             return geometryList
         bboxPolygon = maxMin2Polygon(self.bbox)
+
+        def cap(geometry):
+            if justBoundaries:
+                geometry = geometry.GetBoundary()
+            # geometries lying within the bbox need no intersection
+            if bboxContains(self.bbox, envelope2BBox(geometry)):
+                return geometry
+            return geometry.Intersection(bboxPolygon)
+
         result = []
         for g in geometryList:
             try:
-                if justBoundaries:
-                    g = g.GetBoundary()
-                g = g.Intersection(bboxPolygon)
-                result.append(g)
+                result.append(cap(g))
             except AttributeError:
                 for geom in g:
-                    if justBoundaries:
-                        geom = geom.GetBoundary()
-                    geom = geom.Intersection(bboxPolygon)
-                    result.append(geom)
+                    result.append(cap(geom))
         return result
 
 #    def __getGeometriesInBBox(self, layer, bbox):
@@ -214,16 +715,16 @@ class Feldblock_WFS():
         assert len(bbox) == 4, "BBox needs exactly 4 values"
 
         self.bbox = bbox
-        g = self.__findGeometries(self.__getFeatures(self.fb_layer))
-        g.append(self.__findGeometries(self.__getFeatures(self.le_layer)))
-        g.append(self.__findGeometries(self.__getFeatures(self.nbf_layer)))
+        g = self.__getGeometries(self.fb_layer)
+        g.append(self.__getGeometries(self.le_layer))
+        g.append(self.__getGeometries(self.nbf_layer))
         if len(g) == 0:
             return None
         if cap2Boundaries:
             g = self.__cap2BBoxBoundaries(g)
         return g
 
-    def findGeometriesByGroup(self, bbox, manipulate=False):
+    def findGeometriesByGroup(self, bbox, manipulate=False, seed=None):
         '''
             Find the Geometries within the BBox
 
@@ -232,6 +733,9 @@ class Feldblock_WFS():
             bbox: float[xmin, ymin, xmax, ymax]
             manipulate: boolean
                 - whether the geometries should be manipulated
+            seed: (optional)
+                - seed of the manipulation, e.g. the tile name, so it doesn't
+                depend on the order of the calls
 
             Returns
             -------
@@ -245,12 +749,13 @@ class Feldblock_WFS():
         assert len(bbox) == 4, "BBox needs exactly 4 values"
 
         self.bbox = bbox
-        self.fb = self.__findGeometries(self.__getFeatures(self.fb_layer))
-        self.le = self.__findGeometries(self.__getFeatures(self.le_layer))
-        self.nbf = self.__findGeometries(self.__getFeatures(self.nbf_layer))
+        self.fb = self.__getGeometries(self.fb_layer)
+        self.le = self.__getGeometries(self.le_layer)
+        self.nbf = self.__getGeometries(self.nbf_layer)
 
         if manipulate:
-            self.__manipulate()
+            self.__manipulate(self.random if seed is None
+                              else random.Random(seed))
 
         geometries = self.fb
         geometries.append(self.le)
@@ -262,6 +767,375 @@ class Feldblock_WFS():
         return self.fb, self.le, self.nbf, boundaries
 
 
+def posList2Array(posList):
+    '''
+        The coordinates of a gml:posList
+
+        Returns
+        -------
+        float array of shape (n, 2), x and y of every point
+    '''
+    dimension = int(posList.get('srsDimension', 2))
+    coordinates = np.array(posList.text.split(), dtype=np.float64)
+    return coordinates.reshape(-1, dimension)[:, :2]
+
+
+def polygon2Geometry(rings):
+    '''
+        Builds the Polygon from its rings via WKB
+
+        Parameters
+        ----------
+        rings: float array (n, 2)[]
+            - the exterior ring, then the interior rings
+    '''
+    wkb = [struct.pack('<BII', 1, ogr.wkbPolygon, len(rings))]
+    for points in rings:
+        wkb.append(struct.pack('<I', len(points)))
+        wkb.append(points.astype('<f8').tobytes())
+    return ogr.CreateGeometryFromWkb(b''.join(wkb))
+
+
+def lineString2Geometry(points):
+    '''
+        Builds the LineString from its points (float array (n, 2)) via WKB
+    '''
+    return ogr.CreateGeometryFromWkb(
+        struct.pack('<BII', 1, ogr.wkbLineString, len(points)) +
+        points.astype('<f8').tobytes())
+
+
+def gml2Geometry(element):
+    '''
+        Builds the Geometry of a gml:Polygon or gml:LineString as WKB
+        straight from its posLists, any other GML geometry (or coordinates
+        not given as posList) with ogr.CreateGeometryFromGML
+
+        Parameters
+        ----------
+        element: Element
+            - the parsed GML geometry
+
+        Returns
+        -------
+        Geometry, None if OGR can't read it
+    '''
+    try:
+        if element.tag == GML + 'Polygon':
+            rings = ([element.find(GML + 'exterior')] +
+                     element.findall(GML + 'interior'))
+            return polygon2Geometry([posList2Array(
+                ring.find(GML + 'LinearRing/' + GML + 'posList'))
+                for ring in rings])
+        if element.tag == GML + 'LineString':
+            return lineString2Geometry(posList2Array(
+                element.find(GML + 'posList')))
+    except (AttributeError, ValueError):
+        # no posList or a broken one
+        pass
+    return ogr.CreateGeometryFromGML(ET.tostring(element, encoding='unicode'))
+
+
+def iterGMLFeatures(feature_xml, geometryTag):
+    '''
+        Streams through the GML of a GetFeature response: every feature
+        member is turned into geometries as soon as it is parsed and then
+        dropped, so the document is never held as a whole tree
+
+        Parameters
+        ----------
+        feature_xml: bytes
+            - the response of the WFS
+        geometryTag: string
+            - the tag of the geometry property, like '{ns}the_geom'
+
+        Returns
+        -------
+        generator of (gml:id, Geometry[]) per feature, the parts of its
+        geometry (the_geom/MultiSurface/surfaceMember/*)
+    '''
+    # the open elements, to take the finished feature members off their
+    # parent
+    parents = []
+    for event, element in ET.iterparse(io.BytesIO(feature_xml),
+                                       events=('start', 'end')):
+        if event == 'start':
+            parents.append(element)
+            continue
+        parents.pop()
+        if element.tag != GML + 'featureMember':
+            continue
+        featureId = element[0].get(GML + 'id', element[0].get('fid'))
+        geometries = []
+        for child in element[0].find(geometryTag)[0][0]:
+            geom = gml2Geometry(child)
+            if geom is None:
+                print("Problem with GML:\n",
+                      ET.tostring(child, encoding='unicode'))
+            geometries.append(geom)
+        element.clear()
+        if parents:
+            parents[-1].remove(element)
+        yield featureId, geometries
+
+
+def iterGMLGeometries(feature_xml, geometryTag):
+    '''
+        The Geometries of all features of iterGMLFeatures
+
+        Returns
+        -------
+        generator of the Geometries
+    '''
+    for _, geometries in iterGMLFeatures(feature_xml, geometryTag):
+        for geom in geometries:
+            yield geom
+
+
+def coordinates2Array(coordinates):
+    '''
+        GeoJSON positions as float array (n, 2), x and y of every point
+    '''
+    return np.array([p[:2] for p in coordinates], dtype=np.float64)
+
+
+def geoJSON2Geometries(geometry):
+    '''
+        Builds the Geometries of a GeoJSON geometry, multi geometries are
+        split into their parts like the parts of the GML geometries
+
+        Returns
+        -------
+        Geometry[]
+    '''
+    kind = geometry['type']
+    coordinates = geometry.get('coordinates')
+    if kind == 'Polygon':
+        return [polygon2Geometry([coordinates2Array(ring)
+                                  for ring in coordinates])]
+    if kind == 'MultiPolygon':
+        return [polygon2Geometry([coordinates2Array(ring) for ring in part])
+                for part in coordinates]
+    if kind == 'LineString':
+        return [lineString2Geometry(coordinates2Array(coordinates))]
+    if kind == 'MultiLineString':
+        return [lineString2Geometry(coordinates2Array(part))
+                for part in coordinates]
+    return [ogr.CreateGeometryFromJson(json.dumps(geometry))]
+
+
+def iterGeoJSONFeatures(feature_json, bbox=None):
+    '''
+        The Geometries of a GetFeature response in GeoJSON
+
+        Parameters
+        ----------
+        feature_json: bytes
+            - the FeatureCollection
+        bbox: float[xmin, ymin, xmax, ymax]
+            - the bbox of the request, to verify the CRS of a collection
+              without crs member
+
+        Returns
+        -------
+        generator of (id, Geometry[]) per feature, no geometries for
+        features without geometry, ValueError if the collection names a CRS
+        other than SRS_NAME or, without crs member, if its first geometry
+        lies outside the bbox
+    '''
+    collection = json.loads(feature_json.decode('utf-8'))
+    # older GeoJSON names its CRS, geometries in any other CRS are useless
+    crs = (collection.get('crs') or {}).get('properties', {}).get('name')
+    if crs is not None and SRS_NAME.split(':')[-1] not in str(crs):
+        raise ValueError('GeoJSON in ' + str(crs) + ' instead of ' +
+                         SRS_NAME)
+    # RFC 7946 GeoJSON has no crs member and is in CRS84 (degrees), unless
+    # the WFS followed the srsName: the features must intersect the bbox
+    verified = crs is not None or bbox is None
+    for feature in collection.get('features', []):
+        if feature.get('geometry') is None:
+            yield feature.get('id'), []
+            continue
+        geometries = geoJSON2Geometries(feature['geometry'])
+        if not verified and geometries:
+            if not any(e[0] <= bbox[2] and bbox[0] <= e[1] and
+                       e[2] <= bbox[3] and bbox[1] <= e[3]
+                       for e in (g.GetEnvelope() for g in geometries)):
+                raise ValueError('GeoJSON without crs outside of the bbox ' +
+                                 str(bbox) + ', not in ' + SRS_NAME)
+            verified = True
+        yield feature.get('id'), geometries
+
+
+def iterGeoJSONGeometries(feature_json):
+    '''
+        The Geometries of all features of iterGeoJSONFeatures
+
+        Returns
+        -------
+        generator of the Geometries
+    '''
+    for _, geometries in iterGeoJSONFeatures(feature_json):
+        for geom in geometries:
+            yield geom
+
+
+def detectOutputFormat(wfs):
+    '''
+        Looks for a GeoJSON outputFormat of GetFeature in the capabilities
+
+        Parameters
+        ----------
+        wfs: WebFeatureService
+
+        Returns
+        -------
+        the offered format, None if there is none (GML is used)
+    '''
+    offered = []
+    try:
+        operation = wfs.getOperationByName('GetFeature')
+    except KeyError:
+        return None
+    parameters = getattr(operation, 'parameters', None) or {}
+    offered += parameters.get('outputFormat', {}).get('values', [])
+    offered += getattr(operation, 'formatOptions', None) or []
+
+    lower = dict((f.lower(), f) for f in offered)
+    for outputFormat in JSON_FORMATS:
+        if outputFormat in lower:
+            return lower[outputFormat]
+    # like 'application/json; subtype=geojson'
+    for outputFormat in offered:
+        if 'json' in outputFormat.lower():
+            return outputFormat
+    return None
+
+
+def benchmarkGMLParsing(features=2000, points=100, repeat=3):
+    '''
+        Compares the geometries per second of the former GML parsing
+        (re-serializing every geometry, regexes, ogr.CreateGeometryFromGML)
+        with iterGMLGeometries on a synthetic GetFeature response
+
+        Parameters
+        ----------
+        features: int
+            - number of polygons in the response
+        points: int
+            - number of points of every polygon ring
+    '''
+    mv = 'http://www.geodaten-mv.de/dienste/gdimv_feldblock_wfs'
+    angles = np.linspace(0, 2 * np.pi, points)
+    members = []
+    for k in range(features):
+        x = 33300000 + 50 * (k % 100) + 20 * np.cos(angles)
+        y = 5900000 + 50 * (k // 100) + 20 * np.sin(angles)
+        posList = ' '.join('%.3f %.3f' % p for p in zip(x, y))
+        members.append(
+            '<gml:featureMember><mv:feldbloecke><mv:the_geom>'
+            '<gml:MultiSurface><gml:surfaceMember><gml:Polygon>'
+            '<gml:exterior><gml:LinearRing><gml:posList>' + posList +
+            '</gml:posList></gml:LinearRing></gml:exterior>'
+            '</gml:Polygon></gml:surfaceMember></gml:MultiSurface>'
+            '</mv:the_geom></mv:feldbloecke></gml:featureMember>')
+    feature_xml = ('<wfs:FeatureCollection '
+                   'xmlns:wfs="http://www.opengis.net/wfs" '
+                   'xmlns:gml="http://www.opengis.net/gml" '
+                   'xmlns:mv="' + mv + '">' + ''.join(members) +
+                   '</wfs:FeatureCollection>').encode('utf-8')
+    geometryTag = '{' + mv + '}the_geom'
+
+    def former():
+        geometries = []
+        root = ET.fromstring(feature_xml)
+        for child in root.findall(GML + 'featureMember'):
+            for cchild in child[0].find(geometryTag)[0][0]:
+                geom_gml = str(ET.tostring(cchild, method='xml'))
+                geom_gml = re.sub(r"b'<", "<", geom_gml)
+                geom_gml = re.sub(r">[^>^<]+<^/", "><", geom_gml)
+                geom_gml = re.sub(r">[^>]*'", ">", geom_gml)
+                geometries.append(ogr.CreateGeometryFromGML(geom_gml))
+        return geometries
+
+    def streamed():
+        return list(iterGMLGeometries(feature_xml, geometryTag))
+
+    old = former()
+    new = streamed()
+    assert len(old) == len(new) == features
+    assert all(a.Equals(b) for a, b in zip(old, new)), 'different geometries'
+
+    print(str(features) + ' polygons with ' + str(points) + ' points, ' +
+          str(len(feature_xml) // 1024) + ' KiB GML')
+    for name, parse in [('former', former), ('iterGMLGeometries', streamed)]:
+        seconds = min(timeit.repeat(parse, number=1, repeat=repeat))
+        print(name + ':\t' + str(int(features / seconds)) + ' geometries/s')
+
+
+def numberMatched(data):
+    '''
+        The number of features matching a GetFeature request as its response
+        (bytes) states it, the numberMatched of WFS 2.0 (GML or GeoJSON) or
+        the totalFeatures of GeoServer's GeoJSON, None if it doesn't
+    '''
+    # the root attributes of GML, the last members of GeoJSON
+    for part in [data[:4096], data[-4096:]]:
+        match = re.search(br'(?:numberMatched|totalFeatures)"?\s*[=:]\s*'
+                          br'"?(\d+)', part)
+        if match is not None:
+            return int(match.group(1))
+    return None
+
+
+def testGeoJSONWithoutCRS():
+    '''
+        Checks that a FeatureCollection without crs member is only taken
+        for SRS_NAME if its geometries lie within the bbox of the request
+    '''
+    bbox = [33300000, 5900000, 33301000, 5901000]
+
+    def collection(ring, crs=None):
+        features = [{'type': 'Feature', 'id': 'feldbloecke.1',
+                     'geometry': {'type': 'Polygon', 'coordinates': [ring]}}]
+        data = {'type': 'FeatureCollection', 'features': features}
+        if crs is not None:
+            data['crs'] = {'type': 'name', 'properties': {'name': crs}}
+        return json.dumps(data).encode('utf-8')
+
+    metres = [[33300100, 5900100], [33300200, 5900100],
+              [33300200, 5900200], [33300100, 5900100]]
+    degrees = [[12.1, 53.2], [12.2, 53.2], [12.2, 53.3], [12.1, 53.2]]
+
+    features = list(iterGeoJSONFeatures(collection(metres), bbox))
+    assert len(features) == 1 and len(features[0][1]) == 1
+    features = list(iterGeoJSONFeatures(collection(metres, SRS_NAME), bbox))
+    assert len(features) == 1
+    try:
+        list(iterGeoJSONFeatures(collection(degrees), bbox))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('CRS84 GeoJSON taken for ' + SRS_NAME)
+    try:
+        list(iterGeoJSONFeatures(collection(metres, 'urn:ogc:def:crs:'
+                                            'OGC:1.3:CRS84'), bbox))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('GeoJSON in CRS84 taken for ' + SRS_NAME)
+    print('testGeoJSONWithoutCRS: ok')
+
+
+def isExceptionReport(data):
+    '''
+        Whether the WFS response (bytes) is an OWS exception report instead
+        of features
+    '''
+    head = data[:1024]
+    return b'ExceptionReport' in head or b'ServiceException' in head
+
+
 def maxMin2Polygon(coordinateList):
     '''
         Get Rectangle Polygon for the BBox Coordinates in the list
@@ -287,3 +1161,36 @@ def maxMin2Polygon(coordinateList):
     polygon = ogr.Geometry(ogr.wkbPolygon)
     polygon.AddGeometry(ring)
     return polygon
+
+
+def bboxContains(outer, inner):
+    '''
+        Whether the BBox inner lies completely within the BBox outer
+
+        Parameters
+        ----------
+        outer, inner: float[xmin, ymin, xmax, ymax]
+    '''
+    return (outer[0] <= inner[0] and outer[1] <= inner[1] and
+            inner[2] <= outer[2] and inner[3] <= outer[3])
+
+
+def envelope2BBox(geometry):
+    '''
+        Get the BBox of the envelope of the Geometry
+
+        Parameters
+        ----------
+        geometry: Geometry
+
+        Returns
+        -------
+        float[xmin, ymin, xmax, ymax]
+    '''
+    xmin, xmax, ymin, ymax = geometry.GetEnvelope()
+    return [xmin, ymin, xmax, ymax]
+
+
+if __name__ == '__main__':
+    testGeoJSONWithoutCRS()
+    benchmarkGMLParsing()
@@ -1,14 +1,19 @@
-from owslib.wms import WebMapService
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+import requests
 import ImageHandling as ih
 import GeometryConvertion as gc
 import glob
+import os
+import time
 import numpy as np
 import Params
 import matplotlib.pyplot as plt
 
 
-WMS_DOM = WebMapService(Params.WMS_DOM, version='1.3.0')
 DOM_LAYER = 'schummerung'
+# keep-alive connections to the WMS, shared by all threads
+DOM_SESSION = None
 
 
 def __printWMSInfos(wms):
@@ -24,6 +29,62 @@ def __getDOMFilename(imageFilename):
     return imageFilename[:-4] + Params.DOM_EXTENT + '.png'
 
 
+def getDOMSession():
+    '''
+        Returns the requests session for the WMS, its connection pool keeps
+        up to Params.WMS_WORKERS connections alive
+    '''
+    global DOM_SESSION
+    if DOM_SESSION is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=Params.WMS_WORKERS)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        DOM_SESSION = session
+    return DOM_SESSION
+
+
+def getDOMMap(bbox, retries=Params.WMS_RETRIES):
+    '''
+        Asks the WMS for the DOM Schummerung of the bbox, failed requests
+        are retried with exponential backoff
+
+        Parameters
+        ----------
+        bbox: float[]
+            - [xmin, ymin, xmax, ymax]
+
+        retries: int
+            - number of retries, waiting 1, 2, 4, ... seconds in between
+
+        Returns
+        -------
+        the PNG (bytes)
+    '''
+    assert len(bbox) == 4, 'Wrong length for the bbox'
+    params = {'service': 'WMS', 'version': '1.3.0', 'request': 'GetMap',
+              'layers': DOM_LAYER, 'styles': '', 'crs': 'EPSG:5650',
+              'bbox': ','.join(repr(float(v)) for v in bbox),
+              'width': Params.IMAGE_SIZE_SMALL,
+              'height': Params.IMAGE_SIZE_SMALL,
+              'format': 'image/png', 'transparent': 'FALSE',
+              'exceptions': 'XML'}
+    for attempt in range(retries + 1):
+        try:
+            response = getDOMSession().get(Params.WMS_DOM, params=params,
+                                           timeout=Params.WMS_TIMEOUT)
+            response.raise_for_status()
+            # service exceptions come as XML with status 200
+            if 'image/' not in response.headers.get('Content-Type', ''):
+                raise IOError('WMS answered: ' + response.text[:200])
+            return response.content
+        except IOError:
+            if attempt == retries:
+                raise
+            time.sleep(2 ** attempt)
+
+
 def getDOMMap4ImageAndSaveAsPNG(file, bbox=None):
     '''
         Asks the WMS for the DOM Schummerung and saves it as a PNG
@@ -41,16 +102,61 @@ def getDOMMap4ImageAndSaveAsPNG(file, bbox=None):
 
     if bbox is None:
         bbox = gc.getBBoxForTifFile(file)
-    assert len(bbox) == 4, 'Wrong length for the bbox'
-    size = (Params.IMAGE_SIZE_SMALL, Params.IMAGE_SIZE_SMALL)
-
-    img = WMS_DOM.getmap(layers=[DOM_LAYER], srs='EPSG:5650', bbox=bbox,
-                         size=size, format='image/png')
+    img = getDOMMap(bbox)
 
     savePath = __getDOMFilename(file)
-    out = open(savePath, 'wb')
-    out.write(img.read())
+    # an interrupted write must not look like a finished DOM map
+    tmpPath = savePath + '.part'
+    out = open(tmpPath, 'wb')
+    out.write(img)
     out.close()
+    os.replace(tmpPath, savePath)
+
+
+def fetchDOMMaps(filenames, workers=Params.WMS_WORKERS):
+    '''
+        Gets the DOM maps for many images with parallel requests. Images
+        that already have their DOM map are skipped, so an interrupted run
+        continues where it stopped
+
+        Parameters
+        ----------
+        filenames: String[]
+            - names of the Image files
+
+        workers: int
+            - maximum number of requests at the same time
+
+        Returns
+        -------
+        the filenames whose DOM map could not be fetched
+    '''
+    todo = [f for f in filenames
+            if not os.path.exists(__getDOMFilename(f))]
+    print(len(filenames) - len(todo), '/', len(filenames),
+          'DOM maps already there')
+    failed = []
+    done = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        running = {}
+        todo.reverse()
+        while todo or running:
+            # keep just a few requests queued
+            while todo and len(running) < 2 * workers:
+                f = todo.pop()
+                running[executor.submit(getDOMMap4ImageAndSaveAsPNG, f)] = f
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                f = running.pop(future)
+                try:
+                    future.result()
+                except IOError as err:
+                    print('Unable to get DOM for', f, err)
+                    failed.append(f)
+                done += 1
+                if done % 100 == 0:
+                    print(done, '/', done + len(todo) + len(running))
+    return failed
 
 
 def openDOMImage4ImageFile(file):
@@ -58,18 +164,14 @@ def openDOMImage4ImageFile(file):
 
 
 def main(path=Params.DOP_PATH + Params.SMALL_DOP_TRAIN):
-    # __printWMSInfos(WMS_DOM)
+    # __printWMSInfos(WebMapService(Params.WMS_DOM, version='1.3.0'))
     filenames = glob.glob(path + '*.tif')
     print(len(filenames))
-    for i, file in enumerate(filenames):
-        # generated edge maps are skipped
-        if ih.EDGES_EXTENT in file or Params.DOM_EXTENT in file:
-            continue
-
-        getDOMMap4ImageAndSaveAsPNG(file)
-
-        if i % 100 == 0:
-            print(i, '/', len(filenames))
+    # generated edge maps are skipped
+    filenames = [f for f in filenames
+                 if ih.EDGES_EXTENT not in f and Params.DOM_EXTENT not in f]
+    failed = fetchDOMMaps(filenames)
+    print(len(failed), 'DOM maps failed')
 
 
 def comparing_inputs(file='train.txt',
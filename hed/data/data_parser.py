@@ -1,104 +1,330 @@
 import os
+import glob
+import json
+import hashlib
+import threading
 # import sys
 # import time
 # import wget
 import numpy as np
+import h5py
+import six
+from six.moves import queue
 import tensorflow as tf
-from PIL import Image
 from hed.utils.io import IO
 import cv2
 
 
+def fit_image(image, width, height, ch_swap):
+
+    # cv2 (BGR, uint8) image resized to (height, width) if needed, with the
+    # RGB channels in ch_swap order, one copy
+    if image.shape[:2] != (height, width):
+        image = cv2.resize(image, (width, height),
+                           interpolation=cv2.INTER_NEAREST)
+    return image[:, :, [2 - c for c in ch_swap]]
+
+
+def read_image(filename, width, height, ch_swap):
+
+    # gray and 4 channel images are read as 3 channels
+    image = cv2.imread(filename, cv2.IMREAD_COLOR)
+    if image is None:
+        raise IOError('Unable to open {}'.format(filename))
+    return fit_image(image, width, height, ch_swap)
+
+
+def read_dom(filename, width, height):
+
+    # 1st channel of the DOM PNG
+    dom = cv2.imread(filename, cv2.IMREAD_COLOR)
+    if dom is None:
+        raise IOError('Unable to open {}'.format(filename))
+    dom = dom[:, :, 0]
+    if dom.shape != (height, width):
+        dom = cv2.resize(dom, (width, height),
+                         interpolation=cv2.INTER_NEAREST)
+    return dom
+
+
+def read_edgemap(filename, width, height):
+
+    em = cv2.imread(filename, cv2.IMREAD_GRAYSCALE)
+    if em is None:
+        raise IOError('Unable to open {}'.format(filename))
+    if em.shape != (height, width):
+        em = cv2.resize(em, (width, height),
+                        interpolation=cv2.INTER_NEAREST)
+    return em
+
+
+def subtract_mean(images, mean_pix_val):
+
+    # in place on float32 images [..., H, W, C], just the 3 color channels
+    images[..., :3] -= np.asarray(mean_pix_val, dtype=np.float32)
+    return images
+
+
 class DataParser():
 
     def __init__(self, cfgs):
 
         self.io = IO()
         self.cfgs = cfgs
-        self.train_file = os.path.join(cfgs['download_path'],
-                                       cfgs['training']['list'])
-        self.train_data_dir = os.path.join(cfgs['download_path'],
-                                           cfgs['training']['dir'])
-        self.training_pairs = self.io.read_file_list_not_split(self.train_file)
-
-        self.samples = self.io.split_pair_names(self.training_pairs,
-                                                self.train_data_dir)
-        self.io.print_info('Training data set-up from {}'
-                           .format(os.path.join(self.train_file)))
-        self.n_samples = len(self.training_pairs)
+        self.shards = {}
+        if 'shards' in cfgs['training']:
+            # tiles packed by ImageHandling.ShardWriter
+            pattern = os.path.join(cfgs['download_path'],
+                                   cfgs['training']['shards'])
+            self.samples = self.read_shard_samples(sorted(glob.glob(pattern)))
+            self.io.print_info('Training data set-up from {}'
+                               .format(pattern))
+        else:
+            self.train_file = os.path.join(cfgs['download_path'],
+                                           cfgs['training']['list'])
+            self.train_data_dir = os.path.join(cfgs['download_path'],
+                                               cfgs['training']['dir'])
+            training_pairs = self.io.read_file_list_not_split(self.train_file)
+
+            self.samples = self.io.split_pair_names(training_pairs,
+                                                    self.train_data_dir)
+            self.io.print_info('Training data set-up from {}'
+                               .format(os.path.join(self.train_file)))
+        self.n_samples = len(self.samples)
 
         self.all_ids = range(self.n_samples)
         np.random.shuffle(self.all_ids)
 
         self.training_ids = self.all_ids[:int(self.cfgs['train_split']
-                                         * len(self.training_pairs))]
+                                         * self.n_samples)]
         self.validation_ids = self.all_ids[int(self.cfgs['train_split']
-                                           * len(self.training_pairs)):]
+                                           * self.n_samples):]
+
+        # batch size -> reused (images, edgemaps) arrays
+        self.buffers = {}
+        # preprocessed samples in memory-mapped arrays
+        self.cache_images = None
+        self.cache_edgemaps = None
+        if cfgs.get('cache_dir'):
+            self.setup_cache(cfgs['cache_dir'])
 
         self.io.print_info('Training samples {}'
                            .format(len(self.training_ids)))
         self.io.print_info('Validation samples {}'
                            .format(len(self.validation_ids)))
 
-    def get_training_batch(self):
+    def get_training_batch(self, buffers=None):
         batch_ids = np.random.choice(self.training_ids,
                                      self.cfgs['batch_size_train'])
-        return self.get_batch(batch_ids)
+        return self.get_batch(batch_ids, buffers)
 
-    def get_validation_batch(self):
+    def get_validation_batch(self, buffers=None):
 
         batch_ids = np.random.choice(self.validation_ids,
                                      self.cfgs['batch_size_val'])
-        return self.get_batch(batch_ids)
+        return self.get_batch(batch_ids, buffers)
 
-    def get_batch(self, batch):
+    def allocate_buffers(self, batch_size):
 
-        # tstart = time.time()
+        # [batch_size, H, W, 4] images and [batch_size, H, W, 1] edge maps
+        height = self.cfgs['training']['image_height']
+        width = self.cfgs['training']['image_width']
+        return (np.empty((batch_size, height, width, 4), dtype=np.float32),
+                np.empty((batch_size, height, width, 1), dtype=np.float32))
 
-        filenames = []
-        images = []
-        edgemaps = []
+    def read_shard_samples(self, shard_files):
+
+        # one sample per tile: (shard file, index within the shard)
+        samples = []
+        for shard_file in shard_files:
+            shard = self.get_shard(shard_file)
+            samples += [(shard_file, i) for i in range(len(shard['name']))]
+        return samples
+
+    def get_shard(self, shard_file):
+
+        if shard_file not in self.shards:
+            self.shards[shard_file] = h5py.File(shard_file, 'r')
+        return self.shards[shard_file]
+
+    def load_sample(self, b):
+
+        # resized, channel swapped image + dom and edge map, still uint8
         height = self.cfgs['training']['image_height']
         width = self.cfgs['training']['image_width']
         ch_swap = self.cfgs['channel_swap']
+        sample = self.samples[b]
+
+        if sample[0].endswith('.h5'):
+            shard = self.get_shard(sample[0])
+            im = fit_image(shard['image'][sample[1]], width, height, ch_swap)
+            em = shard['edges'][sample[1]]
+            dom = shard['dom'][sample[1]]
+            if em.shape != (height, width):
+                em = cv2.resize(em, (width, height),
+                                interpolation=cv2.INTER_NEAREST)
+                dom = cv2.resize(dom, (width, height),
+                                 interpolation=cv2.INTER_NEAREST)
+        else:
+            im = read_image(sample[0], width, height, ch_swap)
+            em = read_edgemap(sample[2], width, height)
+            dom = read_dom(sample[1], width, height)
+
+        # 4 input channels, rgb + height
+        return np.concatenate((im, dom.reshape((height, width, 1))), 2), em
+
+    def preprocess(self, images, edgemaps):
+
+        # in place on the float32 buffers still holding the uint8 values
         mean_pix_val = self.cfgs['mean_pixel_value']
         regression = self.cfgs['target_regression']
 
-        for idx, b in enumerate(batch):
+        subtract_mean(images, mean_pix_val)
+
+        # Labels needs to be 1 or 0 (edge pixel or not)
+        # or can use regression targets as done by the author
+        # https://github.com/s9xie/hed/blob/9e74dd710773d8d8a469ad905c76f4a7fa08f945/src/caffe/layers/image_labelmap_data_layer.cpp#L213
+
+        if regression:
+            np.divide(edgemaps, 255.0, out=edgemaps)
+        else:
+            # integer values: every edge pixel becomes 1
+            np.minimum(edgemaps, 1.0, out=edgemaps)
 
-            # im = tf.image.de
-            im = Image.open(self.samples[b][0])
-            em = Image.open(self.samples[b][2])
-            dom = cv2.imread(self.samples[b][1])
+    def cache_key(self):
 
-            im = im.resize((width, height))
-            em = em.resize((width, height))
+        # everything the cached samples depend on, a regenerated data set
+        # with the same names changes the sizes and mtimes of its files
+        files = sorted(set(f for sample in self.samples for f in sample
+                           if isinstance(f, six.string_types)))
+        stats = [(f, os.path.getsize(f), os.path.getmtime(f))
+                 for f in files if os.path.exists(f)]
+        keys = [self.cfgs['training']['image_height'],
+                self.cfgs['training']['image_width'],
+                self.cfgs['channel_swap'], self.samples, stats]
+        return hashlib.sha1(json.dumps(keys).encode('utf-8')).hexdigest()
+
+    def setup_cache(self, cache_dir):
+
+        height = self.cfgs['training']['image_height']
+        width = self.cfgs['training']['image_width']
+        prefix = os.path.join(cache_dir, 'samples-{}'.format(self.cache_key()))
 
-            im = np.array(im, dtype=np.float32)
-            im = im[:, :, ch_swap]
-            im -= mean_pix_val
+        if not os.path.exists(prefix + '.done'):
+            self.io.print_info('Building sample cache {}'.format(prefix))
+            images = np.lib.format.open_memmap(prefix + '-images.npy', 'w+',
+                                               np.uint8, (self.n_samples,
+                                                          height, width, 4))
+            edgemaps = np.lib.format.open_memmap(prefix + '-edgemaps.npy',
+                                                 'w+', np.uint8,
+                                                 (self.n_samples, height,
+                                                  width))
+            for b in range(self.n_samples):
+                images[b], edgemaps[b] = self.load_sample(b)
+                if b % 1000 == 0:
+                    self.io.print_info('Cached {}/{} samples'
+                                       .format(b, self.n_samples))
+            images.flush()
+            edgemaps.flush()
+            del images, edgemaps
+            # an interrupted build is started again
+            open(prefix + '.done', 'w').close()
 
-            # Labels needs to be 1 or 0 (edge pixel or not)
-            # or can use regression targets as done by the author
-            # https://github.com/s9xie/hed/blob/9e74dd710773d8d8a469ad905c76f4a7fa08f945/src/caffe/layers/image_labelmap_data_layer.cpp#L213
+        self.cache_images = np.load(prefix + '-images.npy', mmap_mode='r')
+        self.cache_edgemaps = np.load(prefix + '-edgemaps.npy', mmap_mode='r')
+        self.io.print_info('Sample cache set-up from {}'.format(prefix))
 
-            em = np.array(em.convert('L'), dtype=np.float32)
+    def get_batch(self, batch, buffers=None):
 
-            if regression:
-                bin_em = em / 255.0
+        # tstart = time.time()
+
+        # the batch is written into buffers, reused for the next batch of
+        # this size if not given
+        if buffers is None:
+            if len(batch) not in self.buffers:
+                self.buffers[len(batch)] = self.allocate_buffers(len(batch))
+            buffers = self.buffers[len(batch)]
+        images, edgemaps = buffers
+
+        filenames = []
+        for idx, b in enumerate(batch):
+
+            if self.cache_images is not None:
+                im, em = self.cache_images[b], self.cache_edgemaps[b]
             else:
-                bin_em = np.zeros_like(em)
-                bin_em[np.where(em)] = 1
-
-            # Some edge maps have 3 channels some dont
-            bin_em = bin_em if bin_em.ndim == 2 else bin_em[:, :, 0]
-            # To fit [batch_size, H, W, 1] output of the network
-            bin_em = np.expand_dims(bin_em, 2)
-            # 4 input channels, rgb + height
-            im = np.concatenate((im, dom[:, :, 0].reshape((height, width, 1))),
-                                2)
-            images.append(im)
-            edgemaps.append(bin_em)
+                im, em = self.load_sample(b)
+            images[idx] = im
+            edgemaps[idx, :, :, 0] = em
             filenames.append(self.samples[b])
 
+        self.preprocess(images, edgemaps)
+
         return images, edgemaps, filenames
+
+
+class BatchPrefetcher():
+
+    """
+    Loads training batches with DataParser in background threads and keeps
+    up to queue_size of them ready, so decoding and preprocessing overlap
+    with the training step. The batches are written into a fixed pool of
+    buffers, a batch returned by get stays valid until the next get
+    """
+
+    def __init__(self, data_parser, threads=4, queue_size=8):
+
+        self.data_parser = data_parser
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stopped = threading.Event()
+
+        # queued + being filled + handed out
+        batch_size = data_parser.cfgs['batch_size_train']
+        self.free = queue.Queue()
+        for _ in range(queue_size + threads + 1):
+            self.free.put(data_parser.allocate_buffers(batch_size))
+        self.current = None
+
+        self.threads = [threading.Thread(target=self.work)
+                        for _ in range(threads)]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def work(self):
+
+        while not self.stopped.is_set():
+            try:
+                buffers = self.free.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                batch = self.data_parser.get_training_batch(buffers)
+            except Exception as err:
+                # raised again in get
+                self.free.put(buffers)
+                batch = err
+            while not self.stopped.is_set():
+                try:
+                    self.queue.put(batch, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+
+    def get(self):
+
+        # the previous batch is not used anymore
+        if self.current is not None:
+            self.free.put(self.current)
+            self.current = None
+
+        batch = self.queue.get()
+        if isinstance(batch, Exception):
+            raise batch
+        self.current = (batch[0], batch[1])
+        return batch
+
+    def stop(self):
+
+        self.stopped.set()
+        for t in self.threads:
+            t.join()
@@ -1,15 +1,21 @@
 import os
+import time
+import threading
 import yaml
 import urlparse
 import urllib
-import cStringIO
 import numpy as np
-from PIL import Image
+from six.moves import queue
 import tensorflow as tf
 import cv2
 
 from hed.models.vgg16 import Vgg16
 from hed.utils.io import IO
+from hed.utils.edgemaps import EdgeMapWriter
+from hed.utils.mosaic import (MosaicReader, MosaicWriter, window_origins,
+                              pyramid_weights)
+from hed.data.data_parser import (fit_image, read_image, read_dom,
+                                  subtract_mean)
 
 
 class HEDTester():
@@ -46,53 +52,161 @@ class HEDTester():
 
     def run(self, session):
 
+        # False if the model or edge maps failed
         if not self.init:
-            return
+            return False
 
         path = self.cfgs['download_path']
         testing = self.cfgs['testing']
-        training = self.cfgs['training']
 
         # read test list
         self.model.setup_testing(session)
         filepath = os.path.join(path, testing['list'])
         train_list = self.io.read_file_list(filepath)
-        self.io.print_info('Writing PNGs at {}'
-                           .format(self.cfgs['test_output']))
-
-        for idx, img_lst in enumerate(train_list):
-            # open Image and concat with dom
-            im_filename = os.path.join(path, testing['dir'], img_lst[0])
-            im = self.fetch_image(im_filename)
-            dom_filename = os.path.join(path, testing['dir'], img_lst[1])
-            dom = cv2.imread(dom_filename)
-            dom = dom[:, :, 0].reshape((training['image_height'],
-                                        training['image_width'], 1))
-            im = np.concatenate((im, dom), 2)
-
-            # produce and save edge map
-            edgemap = session.run(self.model.predictions,
-                                  feed_dict={self.model.images: [im]})
-            self.save_egdemaps(edgemap, idx)
-            self.io.print_info('Done testing {}, {}'.format(im_filename,
-                               im.shape))
-
-
-    def save_egdemaps(self, em_maps, index):
-
-        # Take the edge map from the network from side layers and fuse layer
-        em_maps = [e[0] for e in em_maps]
-        em_maps = em_maps + [np.mean(np.array(em_maps), axis=0)]
-
-        for idx, em in enumerate(em_maps):
-            # Thresholding
-            em[em < self.cfgs['testing_threshold']] = 0.0
-            # BW zu WB + 3 Channel Image
-            em = 255.0 * (1.0 - em)
-            em = np.tile(em, [1, 1, 3])
-            em = Image.fromarray(np.uint8(em))
-            em.save(os.path.join(self.cfgs['test_output'],
-                                 'testing-{}-{:03}.png'.format(index, idx)))
+        self.writer = EdgeMapWriter(self.cfgs, self.cfgs['test_output'],
+                                    testing.get('writer_threads', 4))
+        self.io.print_info('Writing {} edge maps at {}'
+                           .format(self.writer.output_format,
+                                   self.cfgs['test_output']))
+
+        # Bilder im Hintergrund laden, waehrend das Netz rechnet
+        batch_size = testing.get('batch_size', 1)
+        batches = queue.Queue(maxsize=2)
+        producer = threading.Thread(target=self.load_batches,
+                                    args=(train_list, batch_size, batches))
+        producer.daemon = True
+        producer.start()
+
+        n_tiles = 0
+        t_start = time.time()
+        while True:
+            batch = batches.get()
+            if batch is None:
+                break
+            indices, images, filenames = batch
+
+            # produce and save edge maps
+            t_batch = time.time()
+            edgemaps = session.run(self.model.predictions,
+                                   feed_dict={self.model.images: images})
+            for k, idx in enumerate(indices):
+                self.save_egdemaps([e[k:k + 1] for e in edgemaps], idx,
+                                   filenames[k])
+                self.io.print_info('Done testing {}, {}'
+                                   .format(filenames[k], images[k].shape))
+            n_tiles += len(indices)
+            self.io.print_info('{} tiles/sec (batch), {} tiles/sec (total)'
+                               .format(len(indices) /
+                                       (time.time() - t_batch),
+                                       n_tiles / (time.time() - t_start)))
+
+        producer.join()
+        errors = self.writer.close()
+        if errors:
+            self.io.print_error('[Testing] {} of {} edge maps not written: {}'
+                                .format(len(errors), n_tiles,
+                                        sorted(idx for idx, _ in errors)))
+            return False
+        return True
+
+    def run_mosaic(self, session, image_file, output_file, dom_file=None):
+
+        # sliding windows over a whole DOP sheet (.tif + .tfw), the fused
+        # edge probabilities blended into one georeferenced raster
+        if not self.init:
+            return
+
+        testing = self.cfgs['testing']
+        height = testing['image_height']
+        width = testing['image_width']
+        batch_size = testing.get('batch_size', 1)
+        overlap = testing.get('mosaic_overlap', 64)
+        self.model.setup_testing(session)
+
+        reader = MosaicReader(image_file, dom_file)
+        if dom_file is None:
+            self.io.print_warning('[Testing] No DOM raster for {}, height '
+                                  'channel set to 0'.format(image_file))
+        geotransform, projection = reader.geotransform()
+        writer = MosaicWriter(output_file, reader.width, reader.height,
+                              height, geotransform, projection,
+                              testing.get('epsg', 5650))
+        weights = pyramid_weights(height, width)
+        xs = window_origins(reader.width, width, overlap)
+        ys = window_origins(reader.height, height, overlap)
+        images = np.empty((batch_size, height, width, 4), np.float32)
+        self.io.print_info('Writing {} windows of {} to {}'
+                           .format(len(xs) * len(ys), image_file,
+                                   output_file))
+
+        t_start = time.time()
+        for row, yoff in enumerate(ys):
+            writer.advance(yoff)
+            strip, dom = reader.read_strip(yoff, height)
+            for k in range(0, len(xs), batch_size):
+                batch = xs[k:k + batch_size]
+                for b, xoff in enumerate(batch):
+                    images[b, :, :, :3] = fit_image(
+                        strip[:, xoff:xoff + width], width, height,
+                        self.cfgs['channel_swap'])
+                    images[b, :, :, 3] = dom[:, xoff:xoff + width]
+                subtract_mean(images[:len(batch)],
+                              self.cfgs['mean_pixel_value'])
+                fused = session.run(self.model.predictions[-1],
+                                    feed_dict={self.model.images:
+                                               images[:len(batch)]})
+                for b, xoff in enumerate(batch):
+                    writer.add(fused[b, :, :, 0], weights, yoff, xoff)
+            self.io.print_info('[{}/{}] rows, {} windows/sec'
+                               .format(row + 1, len(ys),
+                                       (row + 1) * len(xs) /
+                                       (time.time() - t_start)))
+
+        writer.close()
+
+    def load_batches(self, train_list, batch_size, batches):
+
+        # puts (indices, images, filenames) of batch_size tiles, None at end
+        path = self.cfgs['download_path']
+        testing = self.cfgs['testing']
+
+        indices = []
+        images = []
+        filenames = []
+        try:
+            for idx, img_lst in enumerate(train_list):
+                # open Image and concat with dom
+                im_filename = os.path.join(path, testing['dir'], img_lst[0])
+                im = self.fetch_image(im_filename)
+                if im is None:
+                    continue
+                dom_filename = os.path.join(path, testing['dir'], img_lst[1])
+                dom = read_dom(dom_filename, testing['image_width'],
+                               testing['image_height'])
+                im = np.concatenate((im, dom[:, :, np.newaxis]), 2)
+
+                indices.append(idx)
+                images.append(im)
+                filenames.append(im_filename)
+                if len(indices) == batch_size:
+                    batches.put((indices, np.array(images), filenames))
+                    indices = []
+                    images = []
+                    filenames = []
+
+            if indices:
+                batches.put((indices, np.array(images), filenames))
+        except Exception as err:
+            self.io.print_error('[Testing] Error loading images {}'
+                                .format(err))
+        finally:
+            batches.put(None)
+
+    def save_egdemaps(self, em_maps, index, image_file=None):
+
+        # Take the edge map from the network from side layers and fuse layer,
+        # written in the background by self.writer
+        self.writer.put(em_maps, index, image_file)
 
     def fetch_image(self, test_image):
 
@@ -106,8 +220,10 @@ class HEDTester():
                 print(self.io.print_error('[Testing] URL error code : {1} for {0}'.format(test_image, url_response.code)))
                 return None
             try:
-                image_buffer = cStringIO.StringIO(url_response.read())
-                image = self.capture_pixels(image_buffer)
+                image = cv2.imdecode(np.frombuffer(url_response.read(),
+                                                   np.uint8),
+                                     cv2.IMREAD_COLOR)
+                image = self.capture_pixels(image)
             except Exception as err:
                 print(self.io.print_error('[Testing] Error with URL {0} {1}'
                                           .format(test_image, err)))
@@ -116,37 +232,23 @@ class HEDTester():
         # read from disk
         elif os.path.exists(test_image):
             try:
-                fid = open(test_image, 'r')
-                stream = fid.read()
-                fid.close()
-                image_buffer = cStringIO.StringIO(stream)
-                image = self.capture_pixels(image_buffer)
+                image = read_image(test_image,
+                                   self.cfgs['testing']['image_width'],
+                                   self.cfgs['testing']['image_height'],
+                                   self.cfgs['channel_swap'])
+                image = subtract_mean(image.astype(np.float32),
+                                      self.cfgs['mean_pixel_value'])
             except Exception as err:
                 print(self.io.print_error('[Testing] Error with image file {0} {1}'.format(test_image, err)))
                 return None
 
         return image
 
-    def capture_pixels(self, image_buffer):
-
-        image = Image.open(image_buffer)
-        image = image.resize((self.cfgs['testing']['image_width'],
-                              self.cfgs['testing']['image_height']))
-        image = np.array(image, np.float32)
-        image = self.colorize(image)
-
-        image = image[:, :, self.cfgs['channel_swap']]
-        image -= self.cfgs['mean_pixel_value']
+    def capture_pixels(self, image):
 
-        return image
-
-    def colorize(self, image):
-
-        # BW to 3 channel RGB image
-        if image.ndim == 2:
-            image = image[:, :, np.newaxis]
-            image = np.tile(image, (1, 1, 3))
-        elif image.shape[2] == 4:
-            image = image[:, :, :3]
-
-        return image
+        # decoded cv2 image (BGR)
+        image = fit_image(image, self.cfgs['testing']['image_width'],
+                          self.cfgs['testing']['image_height'],
+                          self.cfgs['channel_swap'])
+        return subtract_mean(image.astype(np.float32),
+                             self.cfgs['mean_pixel_value'])
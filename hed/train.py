@@ -1,4 +1,5 @@
 import os
+import time
 import yaml
 # import sys
 # import argparse
@@ -7,7 +8,8 @@ import tensorflow as tf
 
 from hed.models.vgg16 import Vgg16
 from hed.utils.io import IO
-from hed.data.data_parser import DataParser
+from hed.utils.checkpoint import AsyncSaver
+from hed.data.data_parser import DataParser, BatchPrefetcher
 
 
 class HEDTrainer():
@@ -50,11 +52,40 @@ class HEDTrainer():
                                      ['learning_rate'])
         train = opt.minimize(self.model.loss)
         session.run(tf.global_variables_initializer())
+        # ein Saver fuer alle Snapshots
+        saver = AsyncSaver(session, os.path.join(self.cfgs['save_dir'],
+                                                 'models/hed-model'),
+                           max_to_keep=self.cfgs.get('max_to_keep', 0),
+                           asynchronous=self.cfgs.get('async_snapshots',
+                                                      True))
+
+        # Trainingsdaten im Hintergrund laden
+        threads = self.cfgs.get('prefetch_threads', 0)
+        if threads > 0:
+            prefetcher = BatchPrefetcher(train_data, threads,
+                                         self.cfgs.get('prefetch_queue_size',
+                                                       8))
+            next_batch = prefetcher.get
+        else:
+            next_batch = train_data.get_training_batch
+
+        # summed seconds per part of the training steps
+        step_times = dict.fromkeys(['input', 'compute', 'summary', 'snapshot',
+                                    'validation'], 0.0)
 
         for idx in range(self.cfgs['max_iterations']):
-            im, em, _ = train_data.get_training_batch()
-            run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
-            run_metadata = tf.RunMetadata()
+            t_input = time.time()
+            im, em, _ = next_batch()
+            t_compute = time.time()
+
+            # Tracen nur im Profiling-Modus
+            if self.trace_step(idx):
+                run_options = tf.RunOptions(
+                    trace_level=tf.RunOptions.FULL_TRACE)
+                run_metadata = tf.RunMetadata()
+            else:
+                run_options = None
+                run_metadata = None
 
             _, summary, loss = session.run([train, self.model.merged_summary,
                                             self.model.loss],
@@ -62,19 +93,24 @@ class HEDTrainer():
                                                       self.model.edgemaps: em},
                                            options=run_options,
                                            run_metadata=run_metadata)
+            t_done = time.time()
 
-            self.model.train_writer.add_run_metadata(run_metadata,
-                                                     'step{:06}'.format(idx))
+            if run_metadata is not None:
+                self.model.train_writer.add_run_metadata(
+                    run_metadata, 'step{:06}'.format(idx))
             self.model.train_writer.add_summary(summary, idx)
-            self.io.print_info('[{}/{}] TRAINING loss : {}'
-                               .format(idx, self.cfgs['max_iterations'], loss))
+            # input > compute: the step waited for data (input-bound)
+            self.io.print_info('[{}/{}] TRAINING loss : {} (input {:.3f}s, '
+                               'compute {:.3f}s)'
+                               .format(idx, self.cfgs['max_iterations'], loss,
+                                       t_compute - t_input,
+                                       t_done - t_compute))
+            t_snapshot = time.time()
 
             # Session speichern
             if idx % self.cfgs['save_interval'] == 0:
-                saver = tf.train.Saver()
-                saver.save(session, os.path.join(self.cfgs['save_dir'],
-                                                 'models/hed-model'),
-                           global_step=idx)
+                saver.save(idx)
+            t_validation = time.time()
             # Validierung
             if idx % self.cfgs['val_interval'] == 0:
                 im, em, _ = train_data.get_validation_batch()
@@ -87,4 +123,38 @@ class HEDTrainer():
                                    .format(idx, self.cfgs['max_iterations'],
                                            error))
 
+            step_times['input'] += t_compute - t_input
+            step_times['compute'] += t_done - t_compute
+            step_times['summary'] += t_snapshot - t_done
+            step_times['snapshot'] += t_validation - t_snapshot
+            step_times['validation'] += time.time() - t_validation
+
+        saver.close()
+        self.print_step_times(step_times, self.cfgs['max_iterations'])
+
+        if threads > 0:
+            prefetcher.stop()
         self.model.train_writer.close()
+
+    def trace_step(self, idx):
+
+        # FULL_TRACE only for the steps chosen in the profiling config:
+        # start <= idx < stop and/or every every-th step
+        profiling = self.cfgs.get('profiling')
+        if not profiling:
+            return False
+        start = profiling.get('start', 0)
+        stop = profiling.get('stop', start)
+        every = profiling.get('every', 0)
+        return start <= idx < stop or (every > 0 and idx % every == 0)
+
+    def print_step_times(self, step_times, steps):
+
+        total = sum(step_times.values())
+        if steps == 0 or total == 0:
+            return
+        self.io.print_info('Mean step time {:.3f}s'.format(total / steps))
+        for part in ['input', 'compute', 'summary', 'snapshot', 'validation']:
+            self.io.print_info('    {:<10} {:.3f}s ({:.1f}%)'
+                               .format(part, step_times[part] / steps,
+                                       100.0 * step_times[part] / total))
@@ -0,0 +1,88 @@
+import threading
+import tensorflow as tf
+
+
+class AsyncSaver():
+
+    """
+    Saves snapshots of all variables with one saver that keeps the latest
+    max_to_keep snapshots. Asynchronous: the values of one step are copied
+    out of the training session, loaded into a copy of the variables in a
+    separate graph and written from there in a background thread, so
+    training goes on while the snapshot is written
+    """
+
+    def __init__(self, session, save_path, max_to_keep=5, asynchronous=True):
+
+        self.session = session
+        self.save_path = save_path
+        self.asynchronous = asynchronous
+        self.variables = tf.global_variables()
+        self.thread = None
+        self.error = None
+
+        if not asynchronous:
+            self.saver = tf.train.Saver(self.variables,
+                                        max_to_keep=max_to_keep)
+            return
+
+        # the graph of the training session stays unchanged
+        tf.train.export_meta_graph(filename=save_path + '.meta')
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.placeholders = []
+            self.initializers = []
+            var_list = {}
+            for v in self.variables:
+                p = tf.placeholder(v.dtype.base_dtype, v.get_shape())
+                copy = tf.Variable(p, trainable=False)
+                self.placeholders.append(p)
+                self.initializers.append(copy.initializer)
+                # saved under the name of the training variable
+                var_list[v.op.name] = copy
+            self.saver = tf.train.Saver(var_list, max_to_keep=max_to_keep)
+        self.copy_session = tf.Session(graph=self.graph)
+
+    def save(self, global_step):
+
+        if not self.asynchronous:
+            self.saver.save(self.session, self.save_path,
+                            global_step=global_step)
+            return
+
+        # one snapshot at a time
+        self.wait()
+        values = self.session.run(self.variables)
+        self.thread = threading.Thread(target=self.write,
+                                       args=(values, global_step))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, values, global_step):
+
+        try:
+            self.copy_session.run(self.initializers,
+                                  feed_dict=dict(zip(self.placeholders,
+                                                     values)))
+            self.saver.save(self.copy_session, self.save_path,
+                            global_step=global_step, write_meta_graph=False)
+        except Exception as err:
+            # raised again in the training thread
+            self.error = err
+
+    def wait(self):
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+    def close(self):
+
+        if not self.asynchronous:
+            return
+        self.wait()
+        self.copy_session.close()
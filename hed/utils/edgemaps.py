@@ -0,0 +1,138 @@
+import os
+import threading
+import numpy as np
+from six.moves import queue
+from PIL import Image
+
+try:
+    from osgeo import gdal, osr
+except ImportError:
+    gdal = None
+
+from hed.utils.io import IO
+
+
+class EdgeMapWriter():
+
+    """
+    Writes the edge maps of the tester in background threads.
+    Formats: 'png' one image per map (3 channel or single channel uint8),
+    'geotiff' all maps as bands of one tif georeferenced with the bbox of
+    the tile (<tile>_bbox.txt). With fused_only just the output of the fuse
+    layer is kept
+    """
+
+    def __init__(self, cfgs, output_dir, threads=4, queue_size=16):
+
+        testing = cfgs['testing']
+        self.io = IO()
+        self.output_dir = output_dir
+        self.threshold = cfgs['testing_threshold']
+        self.output_format = testing.get('output_format', 'png')
+        self.fused_only = testing.get('fused_only', False)
+        self.single_channel = testing.get('single_channel', False)
+        self.epsg = testing.get('epsg', 5650)
+        assert self.output_format in ['png', 'geotiff'], \
+            'unknown output_format ' + str(self.output_format)
+        if self.output_format == 'geotiff' and gdal is None:
+            raise ImportError('output_format geotiff needs gdal')
+
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.errors = []
+        self.threads = [threading.Thread(target=self.worker)
+                        for _ in range(max(threads, 1))]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def put(self, em_maps, index, image_file=None):
+
+        # blocks if the threads fall behind, keeps the memory bounded
+        self.jobs.put((em_maps, index, image_file))
+
+    def worker(self):
+
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            try:
+                self.write(*job)
+            except Exception as err:
+                self.errors.append((job[1], err))
+                self.io.print_error('[Testing] Error writing edge maps {} {}'
+                                    .format(job[1], err))
+
+    def close(self):
+
+        # (index, error) of every edge map that could not be written
+        for _ in self.threads:
+            self.jobs.put(None)
+        for t in self.threads:
+            t.join()
+        return self.errors
+
+    def write(self, em_maps, index, image_file=None):
+
+        # side layers + fuse layer (+ their mean), each H x W
+        em_maps = [e[0, :, :, 0] for e in em_maps]
+        if self.fused_only:
+            indices = [len(em_maps) - 1]
+            em_maps = em_maps[-1:]
+        else:
+            em_maps = em_maps + [np.mean(np.array(em_maps), axis=0)]
+            indices = range(len(em_maps))
+
+        ems = []
+        for em in em_maps:
+            # Thresholding, BW zu WB
+            em = np.where(em < self.threshold, 0.0, em)
+            ems.append(np.uint8(255.0 * (1.0 - em)))
+
+        if self.output_format == 'geotiff':
+            self.write_geotiff(ems, index, image_file)
+            return
+
+        for idx, em in zip(indices, ems):
+            if not self.single_channel:
+                em = np.tile(em[:, :, np.newaxis], [1, 1, 3])
+            Image.fromarray(em).save(
+                os.path.join(self.output_dir,
+                             'testing-{}-{:03}.png'.format(index, idx)))
+
+    def write_geotiff(self, ems, index, image_file):
+
+        height, width = ems[0].shape
+        driver = gdal.GetDriverByName('GTiff')
+        raster = driver.Create(os.path.join(self.output_dir,
+                                            'testing-{}.tif'.format(index)),
+                               width, height, len(ems), gdal.GDT_Byte,
+                               ['COMPRESS=DEFLATE', 'PREDICTOR=2',
+                                'TILED=YES'])
+
+        bbox = self.read_bbox(image_file)
+        if bbox is not None:
+            xmin, ymin, xmax, ymax = bbox
+            raster.SetGeoTransform((xmin, (xmax - xmin) / width, 0,
+                                    ymax, 0, -(ymax - ymin) / height))
+            srs = osr.SpatialReference()
+            srs.ImportFromEPSG(self.epsg)
+            raster.SetProjection(srs.ExportToWkt())
+
+        for band, em in enumerate(ems):
+            raster.GetRasterBand(band + 1).WriteArray(em)
+        raster.FlushCache()
+        raster = None
+
+    def read_bbox(self, image_file):
+
+        # '<tile>.tif' -> '<tile>_bbox.txt', xmin, ymin, xmax, ymax
+        if image_file is None:
+            return None
+        bbox_file = os.path.splitext(image_file)[0] + '_bbox.txt'
+        if not os.path.exists(bbox_file):
+            self.io.print_warning('[Testing] No bbox for {}, GeoTIFF without '
+                                  'georeference'.format(image_file))
+            return None
+        with open(bbox_file) as f:
+            return [float(v) for v in f.read().split()]
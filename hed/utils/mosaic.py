@@ -0,0 +1,140 @@
+import numpy as np
+
+try:
+    from osgeo import gdal, osr
+except ImportError:
+    gdal = None
+
+
+def window_origins(size, window, overlap):
+
+    # upper left corners of windows covering 0..size, the last one aligned
+    # to the end
+    assert size >= window, 'image smaller than one window'
+    stride = window - overlap
+    assert stride > 0, 'overlap must be smaller than the window'
+    origins = list(range(0, size - window, stride))
+    origins.append(size - window)
+    return origins
+
+
+def pyramid_weights(height, width):
+
+    # 1 at the border rising linearly to the center, so overlapping windows
+    # fade into each other without seams
+    y = np.minimum(np.arange(1, height + 1), np.arange(height, 0, -1))
+    x = np.minimum(np.arange(1, width + 1), np.arange(width, 0, -1))
+    return np.minimum(y[:, np.newaxis], x[np.newaxis, :]).astype(np.float32)
+
+
+class MosaicReader():
+
+    """
+    Reads row strips of a big image (BGR like cv2.imread) and optionally of
+    a DOM raster covering the same extent, resampled to the image grid.
+    The georeference comes from the tif or its .tfw world file
+    """
+
+    def __init__(self, image_file, dom_file=None):
+
+        if gdal is None:
+            raise ImportError('mosaic inference needs gdal')
+        self.dataset = gdal.Open(image_file)
+        if self.dataset is None:
+            raise IOError('Unable to open {}'.format(image_file))
+        self.width = self.dataset.RasterXSize
+        self.height = self.dataset.RasterYSize
+        self.bands = [3, 2, 1] if self.dataset.RasterCount >= 3 else [1, 1, 1]
+        self.dom = None
+        if dom_file is not None:
+            self.dom = gdal.Open(dom_file)
+            if self.dom is None:
+                raise IOError('Unable to open {}'.format(dom_file))
+
+    def geotransform(self):
+
+        return self.dataset.GetGeoTransform(), self.dataset.GetProjection()
+
+    def read_strip(self, yoff, rows):
+
+        image = np.dstack([self.dataset.GetRasterBand(b)
+                           .ReadAsArray(0, yoff, self.width, rows)
+                           for b in self.bands])
+
+        if self.dom is None:
+            dom = np.zeros((rows, self.width), np.uint8)
+        else:
+            # same extent, scaled to the pixels of the image
+            sy = float(self.dom.RasterYSize) / self.height
+            # the rounded window must stay within the DOM raster
+            dom_yoff = min(int(round(yoff * sy)), self.dom.RasterYSize - 1)
+            dom_rows = min(max(int(round(rows * sy)), 1),
+                           self.dom.RasterYSize - dom_yoff)
+            dom = self.dom.GetRasterBand(1).ReadAsArray(
+                0, dom_yoff, self.dom.RasterXSize, dom_rows,
+                buf_xsize=self.width, buf_ysize=rows)
+            dom = dom.astype(np.uint8)
+        return image, dom
+
+
+class MosaicWriter():
+
+    """
+    Blends weighted window predictions in a rolling accumulator of one
+    window height and writes every finished row range to a georeferenced
+    Float32 GeoTIFF, so only one strip of the sheet is held in memory
+    """
+
+    def __init__(self, output_file, width, height, window_height,
+                 geotransform, projection, epsg=5650):
+
+        driver = gdal.GetDriverByName('GTiff')
+        self.raster = driver.Create(output_file, width, height, 1,
+                                    gdal.GDT_Float32,
+                                    ['COMPRESS=DEFLATE', 'PREDICTOR=3',
+                                     'TILED=YES', 'BIGTIFF=IF_SAFER'])
+        self.raster.SetGeoTransform(geotransform)
+        if not projection:
+            # sheets georeferenced just by a .tfw have no CRS
+            srs = osr.SpatialReference()
+            srs.ImportFromEPSG(epsg)
+            projection = srs.ExportToWkt()
+        self.raster.SetProjection(projection)
+        self.band = self.raster.GetRasterBand(1)
+        self.height = height
+        self.values = np.zeros((window_height, width), np.float32)
+        self.weights = np.zeros((window_height, width), np.float32)
+        self.top = 0
+
+    def advance(self, top):
+
+        # rows above top get no more windows: write them and roll up
+        done = top - self.top
+        if done <= 0:
+            return
+        self.flush(done)
+        self.values[:-done] = self.values[done:]
+        self.weights[:-done] = self.weights[done:]
+        self.values[-done:] = 0
+        self.weights[-done:] = 0
+        self.top = top
+
+    def add(self, em, weights, yoff, xoff):
+
+        rows, cols = em.shape
+        y = yoff - self.top
+        self.values[y:y + rows, xoff:xoff + cols] += em * weights
+        self.weights[y:y + rows, xoff:xoff + cols] += weights
+
+    def flush(self, rows):
+
+        self.band.WriteArray(self.values[:rows] /
+                             np.maximum(self.weights[:rows], 1e-6),
+                             0, self.top)
+
+    def close(self):
+
+        self.flush(self.height - self.top)
+        self.band.FlushCache()
+        self.band = None
+        self.raster = None
@@ -23,12 +23,12 @@ def get_session(gpu_fraction):
 
 def main(args):
 
-    if not (args.run_train or args.run_test or args.download_data):
-        print 'Set atleast one of the options --train | --test | --download-data'
+    if not (args.run_train or args.run_test or args.mosaic or args.download_data):
+        print 'Set atleast one of the options --train | --test | --mosaic | --download-data'
         parser.print_help()
         return
 
-    if args.run_test or args.run_train:
+    if args.run_test or args.run_train or args.mosaic:
         session = get_session(args.gpu_limit)
 
     if args.run_train:
@@ -41,7 +41,15 @@ def main(args):
 
         tester = HEDTester(args.config_file)
         tester.setup(session)
-        tester.run(session)
+        if not tester.run(session):
+            sys.exit(1)
+
+    if args.mosaic:
+
+        output = args.mosaic_output or os.path.splitext(args.mosaic)[0] + '_edges.tif'
+        tester = HEDTester(args.config_file)
+        tester.setup(session)
+        tester.run_mosaic(session, args.mosaic, output, args.mosaic_dom)
 
     if args.download_data:
 
@@ -56,6 +64,9 @@ if __name__ == '__main__':
     parser.add_argument('--config-file', dest='config_file', type=str, help='Experiment configuration file')
     parser.add_argument('--train', dest='run_train', action='store_true', default=False, help='Launch training')
     parser.add_argument('--test', dest='run_test', action='store_true', default=False, help='Launch testing on a list of images')
+    parser.add_argument('--mosaic', dest='mosaic', type=str, default=None, help='Launch testing on a whole DOP sheet (.tif + .tfw)')
+    parser.add_argument('--mosaic-dom', dest='mosaic_dom', type=str, default=None, help='DOM raster covering the same extent as the --mosaic sheet')
+    parser.add_argument('--mosaic-output', dest='mosaic_output', type=str, default=None, help='Edge probability GeoTIFF of the --mosaic sheet (default <sheet>_edges.tif)')
     parser.add_argument('--download-data', dest='download_data', action='store_true', default=False, help='Download training data')
     parser.add_argument('--gpu-limit', dest='gpu_limit', type=float, default=1.0, help='Use fraction of GPU memory (Useful with TensorFlow backend)')
 